@@ -0,0 +1,315 @@
+"""Benchmarks for the HandeeFramer engine.
+
+Generates synthetic spec documents for every notation the parser handles
+and times each stage of a build against them:
+
+    python benchmarks/bench_handeeframer.py [--scale N] [--repeat R]
+    python benchmarks/bench_handeeframer.py --save-baseline
+    python benchmarks/bench_handeeframer.py --compare
+
+Throughput is reported as lines/s for the text stages and files/s for the
+build. --save-baseline stores the results as JSON; --compare checks a run
+against a saved baseline and exits non-zero if any stage got slower than
+the tolerance allows.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from handeeframer import (  # noqa: E402
+    BuildLogger, CodeFenceDetector, DocumentLines, TreeBuilder, TreeDetector, TreeParser,
+)
+
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+
+EXTENSIONS = ['.py', '.js', '.md', '.json', '.css', '.txt']
+EMOJIS = ['\U0001F4C1', '\U0001F4C4', '\U0001F680']
+
+
+# ---------------------------------------------------------------------------
+# Synthetic spec generators
+#
+# Each generator returns a complete markdown document: a "Project Structure"
+# heading, the tree, then a "Files" section with fences for some of its files.
+# `scale` is roughly the number of files in the tree.
+# ---------------------------------------------------------------------------
+
+def _layout(scale, per_dir=10, depth=3):
+    """Yield (depth, name, is_dir) entries of a balanced tree, depth first."""
+    counter = [0]
+
+    def walk(level):
+        for d in range(per_dir // 3 if level < depth else 0):
+            if counter[0] >= scale:
+                return
+            yield level, 'dir{0}_{1}'.format(level, counter[0]), True
+            for entry in walk(level + 1):
+                yield entry
+        for f in range(per_dir):
+            if counter[0] >= scale:
+                return
+            counter[0] += 1
+            yield level, 'file{0}{1}'.format(counter[0], EXTENSIONS[counter[0] % len(EXTENSIONS)]), False
+
+    while counter[0] < scale:
+        for entry in walk(0):
+            yield entry
+
+
+def _document(tree_lines, fences):
+    parts = ["# Synthetic spec", "", "Intro text that is not part of the tree.", "",
+             "## Project Structure", "", "project"]
+    parts.extend(tree_lines)
+    parts.extend(["", "## Files", ""])
+    for name, body in fences:
+        parts.append(name)
+        parts.append("```")
+        parts.extend(body)
+        parts.append("```")
+        parts.append("")
+    return "\n".join(parts) + "\n"
+
+
+def _fence_body(i, lines=5):
+    return ["line {0} of file {1}".format(n, i) for n in range(lines)]
+
+
+def gen_indented(scale):
+    """Whitespace-indented tree with a fence for every tenth file."""
+    tree, fences = [], []
+    for depth, name, is_dir in _layout(scale):
+        tree.append("  " * (depth + 1) + name + ("/" if is_dir else ""))
+        if not is_dir and len(tree) % 10 == 0:
+            fences.append((name, _fence_body(len(tree))))
+    return _document(tree, fences)
+
+
+def gen_box(scale):
+    """Box-drawing tree with emojis and trailing comments."""
+    tree = []
+    for depth, name, is_dir in _layout(scale):
+        prefix = "│   " * depth + "├── "
+        emoji = EMOJIS[0] if is_dir else EMOJIS[len(tree) % 2 + 1]
+        line = "{0}{1} {2}{3}".format(prefix, emoji, name, "/" if is_dir else "")
+        if not is_dir and len(tree) % 4 == 0:
+            line += "  # generated entry"
+        tree.append(line)
+    return _document(tree, [])
+
+
+def gen_shorthand(scale):
+    """Slash-separated paths, one file per line."""
+    tree, fences = [], []
+    for i in range(scale):
+        path = "pkg{0}/mod{1}/file{2}{3}".format(i % 20, i % 7, i, EXTENSIONS[i % len(EXTENSIONS)])
+        tree.append("  " + path)
+        if i % 10 == 0:
+            fences.append((path, _fence_body(i)))
+    return _document(tree, fences)
+
+
+def gen_mixed(scale):
+    """Indented directories holding shorthand paths and box-drawn entries."""
+    tree = []
+    for i in range(scale):
+        if i % 30 == 0:
+            tree.append("  group{0}/".format(i))
+        if i % 3 == 0:
+            tree.append("    sub{0}/leaf{0}.py".format(i))
+        elif i % 3 == 1:
+            tree.append("    ├── {0} item{1}.js".format(EMOJIS[1], i))
+        else:
+            tree.append("    plain{0}.txt".format(i))
+    return _document(tree, [])
+
+
+def gen_fences(scale):
+    """Small tree followed by thousands of root-level and nested fences."""
+    tree = ["  src/"]
+    tree.extend("    file{0}.md".format(i) for i in range(max(1, scale // 10)))
+    fences = []
+    for i in range(scale):
+        name = "src/file{0}.md".format(i % max(1, scale // 10))
+        body = _fence_body(i, 3)
+        if i % 5 == 0:
+            body = body + ["```python", "print({0})".format(i), "```"] + body
+        fences.append((name, body))
+    return _document(tree, fences)
+
+
+GENERATORS = [
+    ('indented', gen_indented),
+    ('box', gen_box),
+    ('shorthand', gen_shorthand),
+    ('mixed', gen_mixed),
+    ('fences', gen_fences),
+]
+
+
+# ---------------------------------------------------------------------------
+# Timing
+# ---------------------------------------------------------------------------
+
+def _best(func, repeat):
+    """Run func `repeat` times; return (best seconds, last result)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _rate(count, seconds):
+    return count / seconds if seconds > 0 else float('inf')
+
+
+def bench_document(text, repeat, workdir):
+    """Time every stage on one document; return {stage: {seconds, rate, unit}}."""
+    lines = text.count("\n") + 1
+    results = {}
+
+    seconds, doc = _best(lambda: DocumentLines(text), repeat)
+    results['tokenize'] = (seconds, lines, 'lines/s')
+
+    seconds, (start, end) = _best(lambda: TreeDetector.find_tree_start(text, doc), repeat)
+    results['detect'] = (seconds, lines, 'lines/s')
+
+    seconds, nodes = _best(lambda: TreeParser(text, start_line=start, end_line=end, doc=doc).parse(),
+                           repeat)
+    # With no end found the tree runs to the end of the document
+    results['parse'] = (seconds, (lines if end is None else end) - start, 'lines/s')
+
+    seconds, fences = _best(lambda: CodeFenceDetector.find_code_fences(text, None, doc), repeat)
+    results['fences'] = (seconds, lines, 'lines/s')
+
+    # Every build goes into a fresh directory so nothing is skipped
+    runs = []
+
+    def build():
+        root = tempfile.mkdtemp(dir=workdir)
+        logger = BuildLogger(root, level=BuildLogger.WARNING, stream=False)
+        stats = TreeBuilder(root, logger).build(nodes, fences)
+        runs.append(root)
+        return stats
+
+    seconds, stats = _best(build, repeat)
+    results['build'] = (seconds, stats['files'], 'files/s')
+    for root in runs:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return dict(
+        (stage, {'seconds': round(s, 6), 'count': count, 'rate': round(_rate(count, s), 1),
+                 'unit': unit})
+        for stage, (s, count, unit) in results.items()
+    )
+
+
+def run(scale, repeat, only=None):
+    workdir = tempfile.mkdtemp(prefix='handeeframer-bench-')
+    try:
+        report = {}
+        for name, generator in GENERATORS:
+            if only and name not in only:
+                continue
+            text = generator(scale)
+            report[name] = bench_document(text, repeat, workdir)
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(report, baseline=None):
+    header = "{0:<10} {1:<9} {2:>12} {3:>16}".format("spec", "stage", "seconds", "throughput")
+    if baseline:
+        header += " {0:>9}".format("vs base")
+    print(header)
+    print("-" * len(header))
+    for name, stages in report.items():
+        for stage, result in stages.items():
+            line = "{0:<10} {1:<9} {2:>12.4f} {3:>10.0f} {4}".format(
+                name, stage, result['seconds'], result['rate'], result['unit'])
+            base = (baseline or {}).get(name, {}).get(stage)
+            if base and base['rate']:
+                line += " {0:>8.0%}".format(result['rate'] / base['rate'])
+            print(line)
+
+
+def regressions(report, baseline, tolerance):
+    """Return (spec, stage, ratio) for stages slower than baseline by more than tolerance."""
+    slower = []
+    for name, stages in report.items():
+        for stage, result in stages.items():
+            base = baseline.get(name, {}).get(stage)
+            if not base or not base['rate']:
+                continue
+            ratio = result['rate'] / base['rate']
+            if ratio < 1 - tolerance:
+                slower.append((name, stage, ratio))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the HandeeFramer engine.")
+    parser.add_argument('--scale', type=int, default=2000,
+                        help="approximate number of files per synthetic spec (default 2000)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per stage; the fastest is reported (default 3)")
+    parser.add_argument('--only', action='append', choices=[name for name, _ in GENERATORS],
+                        help="benchmark only this spec kind (repeatable)")
+    parser.add_argument('--save-baseline', nargs='?', const=DEFAULT_BASELINE, metavar='FILE',
+                        help="save results as the baseline (default benchmarks/baseline.json)")
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, metavar='FILE',
+                        help="compare against a saved baseline and fail on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed throughput drop before --compare fails (default 0.25)")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('scale') != args.scale:
+            print("Baseline was recorded at scale {0}; use --scale {0}".format(saved.get('scale')),
+                  file=sys.stderr)
+            return 2
+        baseline = saved['results']
+
+    report = run(args.scale, args.repeat, args.only)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'scale': args.scale, 'python': sys.version.split()[0], 'results': report},
+                      f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Baseline saved to {0}".format(args.save_baseline))
+
+    if baseline:
+        slower = regressions(report, baseline, args.tolerance)
+        for name, stage, ratio in slower:
+            print("REGRESSION: {0}/{1} at {2:.0%} of baseline".format(name, stage, ratio),
+                  file=sys.stderr)
+        if slower:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
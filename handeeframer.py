@@ -1,8 +1,40 @@
-import sublime  # type: ignore
-import sublime_plugin  # type: ignore
+import argparse
+import fnmatch
+import hashlib
+import io
+import json
 import os
+import posixpath
 import re
-from datetime import datetime
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from itertools import accumulate
+
+try:
+    import sublime  # type: ignore
+    import sublime_plugin  # type: ignore
+except ImportError:
+    # Outside Sublime Text (command line, CI) only the build engine is used;
+    # the command classes below still need base classes to be defined.
+    sublime = None
+
+    class sublime_plugin:  # noqa: N801
+        TextCommand = object
+        WindowCommand = object
+        EventListener = object
 
 
 # ========================================
@@ -12,28 +44,184 @@ from datetime import datetime
 # Set to False to auto-delete logs when no errors occur
 DEBUG_MODE = True
 # ========================================
-print("HandeeFramer LOADED:", __file__, "DEBUG_MODE=", DEBUG_MODE)
+if sublime is not None:
+    print("HandeeFramer LOADED:", __file__, "DEBUG_MODE=", DEBUG_MODE)
+
+SETTINGS_FILE = 'HandeeFramer.sublime-settings'
+STATUS_KEY = 'handeeframer'
+
+# Trace file written next to the build log when the write_trace setting is on
+TRACE_FILENAME = 'handeeframer_trace.jsonl'
+
+# Build log size cap before rotating, and how many rotated logs to keep
+DEFAULT_LOG_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT = 3
+
+
+class BuildCancelled(Exception):
+    """Raised when the user cancels a running build."""
+
+
+class BuildError(Exception):
+    """Raised for problems the user should see as a plain error dialog."""
+
+
+class BuildProgress:
+    """Carries progress reports and the cancellation flag between threads."""
+
+    def __init__(self, callback=None, interval=0.1):
+        self.callback = callback
+        self.interval = interval
+        self._cancel_event = threading.Event()
+        self._last_report = 0.0
+
+    def cancel(self):
+        """Request cancellation; the build stops at its next checkpoint."""
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check(self):
+        """Raise BuildCancelled if cancellation was requested."""
+        if self._cancel_event.is_set():
+            raise BuildCancelled()
+
+    def update(self, message, *args, **kwargs):
+        """Check for cancellation and report progress, throttled to `interval`.
+
+        Formatting is deferred until a report is actually sent.
+        """
+        self.check()
+        if self.callback is None:
+            return
+        now = time.time()
+        if kwargs.get('force') or now - self._last_report >= self.interval:
+            self._last_report = now
+            self.callback(message.format(*args) if args else message)
+
+
+class BuildTrace:
+    """Machine-readable record of one build, written as JSON lines.
+
+    Each timed phase becomes one 'phase' record; write() adds a final
+    'summary' record with the totals set through update().
+    """
+
+    def __init__(self):
+        self.build_id = uuid.uuid4().hex
+        self.started = datetime.now().isoformat()
+        self.phases = []
+        self.fields = {}
+        self._start_ns = time.perf_counter_ns()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as one named phase."""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            self.phases.append({
+                'phase': name,
+                'start_ns': start - self._start_ns,
+                'duration_ns': end - start,
+            })
+
+    def update(self, **fields):
+        """Set fields reported in the summary record."""
+        self.fields.update(fields)
+
+    def records(self, outcome):
+        """Return the trace as a list of dicts, ending with the summary."""
+        records = []
+        for phase in self.phases:
+            record = {'event': 'phase', 'build': self.build_id}
+            record.update(phase)
+            records.append(record)
+
+        summary = {
+            'event': 'summary',
+            'build': self.build_id,
+            'started': self.started,
+            'outcome': outcome,
+            'total_ns': time.perf_counter_ns() - self._start_ns,
+        }
+        summary.update(self.fields)
+        records.append(summary)
+        return records
+
+    def write(self, path, outcome):
+        """Append the trace to a JSONL file. Returns False if it can't be written."""
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                for record in self.records(outcome):
+                    f.write(json.dumps(record, sort_keys=True))
+                    f.write("\n")
+        except (IOError, OSError):
+            return False
+        return True
+
 
 class BuildLogger:
-    """Handles logging for HandeeFramer builds."""
+    """Handles logging for HandeeFramer builds.
 
-    def __init__(self, root_path):
+    Events below `level` are dropped on entry. The rest are stored with their
+    format arguments and a monotonic timestamp, and only turned into text when
+    the log is written out.
+
+    With `stream` on, pending entries are written to the log file in chunks
+    as the build runs, so memory stays bounded and a crash keeps the log so
+    far. Once the file reaches `max_bytes` it is rotated to
+    handeeframer_log.1.txt, .2.txt, ... keeping `backup_count` old files.
+    """
+
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+    # Pseudo-level for section headers; always recorded
+    _SECTION = None
+
+    # Pending entries are written out once this many have accumulated
+    FLUSH_EVERY = 500
+
+    def __init__(self, root_path, level=INFO, stream=True,
+                 max_bytes=DEFAULT_LOG_MAX_BYTES, backup_count=DEFAULT_LOG_BACKUP_COUNT):
         self.root_path = root_path
         self.log_path = os.path.join(root_path, 'handeeframer_log.txt')
-        self.entries = []
+        self.level = level
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.entries = []  # Pending plain lines, or (level, clock, message, args, context, details) events
         self.has_errors = False
         self.start_time = datetime.now()
+        self._start_clock = time.monotonic()
+
+        self._handle = None  # Buffered binary handle, opened on first flush
+        self._bytes_written = 0
+        self._rotations = 0
+        self._write_failed = False
 
         self._write_header()
 
+    def _append(self, entry):
+        self.entries.append(entry)
+        if self.stream and len(self.entries) >= self.FLUSH_EVERY:
+            self.flush()
+
     def section(self, title):
         """Log a section header for readability."""
-        timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        self.entries.append("")
-        self.entries.append("[{0}] {1}".format(timestamp, "=" * 60))
-        self.entries.append("[{0}] {1}".format(timestamp, title))
-        self.entries.append("[{0}] {1}".format(timestamp, "=" * 60))
-        self.entries.append("")
+        self._append((self._SECTION, time.monotonic(), title, (), None, None))
 
     def _write_header(self):
         self.entries.append("=" * 70)
@@ -45,42 +233,150 @@ class BuildLogger:
         self.entries.append("=" * 70)
         self.entries.append("")
 
-    def info(self, message, context=None):
-        timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        self.entries.append("[{0}] INFO: {1}".format(timestamp, message))
-        if context:
-            self.entries.append("  Context: {0}".format(context))
+    def is_enabled_for(self, level):
+        """Whether events at this level are recorded."""
+        return level >= self.level
 
-    def warning(self, message, context=None):
-        timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        self.entries.append("[{0}] WARNING: {1}".format(timestamp, message))
-        if context:
-            self.entries.append("  Context: {0}".format(context))
+    def debug(self, message, *args, context=None):
+        """Log a per-item detail; recorded only at DEBUG level (the verbose setting).
+
+        `message` is formatted with `args` when the log is written. `context`
+        may be a string or a (format, arg, ...) tuple, also formatted late.
+        """
+        if self.DEBUG >= self.level:
+            self._append((self.DEBUG, time.monotonic(), message, args, context, None))
+
+    def info(self, message, *args, context=None):
+        if self.INFO >= self.level:
+            self._append((self.INFO, time.monotonic(), message, args, context, None))
+
+    def warning(self, message, *args, context=None):
+        if self.WARNING >= self.level:
+            self._append((self.WARNING, time.monotonic(), message, args, context, None))
 
     def error(self, message, exception=None, context=None):
         self.has_errors = True
-        timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        self.entries.append("[{0}] ERROR: {1}".format(timestamp, message))
+        details = None
 
         if exception:
-            self.entries.append("  Exception: {0}: {1}".format(type(exception).__name__, str(exception)))
+            # The traceback only exists now, so capture it as text right away
+            details = ["  Exception: {0}: {1}".format(type(exception).__name__, str(exception))]
             import traceback
             tb = traceback.format_exc()
             if tb and "NoneType: None" not in tb:
 
-                self.entries.append("  Traceback:")
+                details.append("  Traceback:")
                 for line in tb.splitlines():
                     if line.strip():
-                        self.entries.append("    {0}".format(line))
-
+                        details.append("    {0}".format(line))
+
+        self._append((self.ERROR, time.monotonic(), message, (), context, details))
+        if self.stream:
+            # Get errors onto disk right away in case the build dies next
+            self.flush()
+
+    def _format_entry(self, entry):
+        """Turn a stored entry into its text lines."""
+        if isinstance(entry, str):
+            return [entry]
+
+        level, clock, message, args, context, details = entry
+        elapsed = timedelta(seconds=clock - self._start_clock)
+        timestamp = (self.start_time + elapsed).strftime('%H:%M:%S.%f')[:-3]
+        if args:
+            message = message.format(*args)
+
+        if level is self._SECTION:
+            rule = "[{0}] {1}".format(timestamp, "=" * 60)
+            return ["", rule, "[{0}] {1}".format(timestamp, message), rule, ""]
+
+        lines = ["[{0}] {1}: {2}".format(timestamp, self.LEVEL_NAMES[level], message)]
+        # Exception details come before the context, as they always have
+        if details:
+            lines.extend(details)
         if context:
-            self.entries.append("  Context: {0}".format(context))
+            if isinstance(context, tuple):
+                context = context[0].format(*context[1:])
+            lines.append("  Context: {0}".format(context))
+        return lines
+
+    def flush(self):
+        """Write pending entries to the log file as one chunk, flushed to the OS."""
+        if not self.entries or self._write_failed:
+            return
+
+        chunk = "".join(
+            line + "\n" for entry in self.entries for line in self._format_entry(entry))
+        del self.entries[:]
+
+        try:
+            if self._handle is None:
+                os.makedirs(self.root_path, exist_ok=True)
+                self._handle = open(self.log_path, 'wb')
+                self._bytes_written = 0
+
+            data = chunk.encode('utf-8')
+            self._handle.write(data)
+            self._bytes_written += len(data)
+
+            if self.max_bytes and self._bytes_written >= self.max_bytes:
+                self._rotate()
+            # Hand the chunk to the OS, so the log so far survives a crash
+            self._handle.flush()
+        except (IOError, OSError):
+            # If we can't write a log, there's nothing else to do here.
+            self._write_failed = True
+            self._close()
+
+    def _backup_path(self, index):
+        base, ext = os.path.splitext(self.log_path)
+        return "{0}.{1}{2}".format(base, index, ext)
+
+    def _rotate(self):
+        """Move the full log aside and start a new one."""
+        self._close()
+
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(self._backup_path(index)):
+                    os.replace(self._backup_path(index), self._backup_path(index + 1))
+            os.replace(self.log_path, self._backup_path(1))
+        else:
+            os.remove(self.log_path)
+        self._rotations += 1
+
+        self._handle = open(self.log_path, 'wb')
+        self._bytes_written = 0
+        self._handle.write("(Log rotated; earlier entries are in {0})\n\n".format(
+            os.path.basename(self._backup_path(1))).encode('utf-8'))
+
+    def _close(self):
+        if self._handle is not None:
+            try:
+                self._handle.close()
+            except (IOError, OSError):
+                pass
+            self._handle = None
 
     def finalize(self, created_dirs_count=0, created_files_count=0, skipped_count=0):
         """Write summary and flush log to disk. Returns log_path if kept, else None."""
         end_time = datetime.now()
         elapsed = (end_time - self.start_time).total_seconds()
 
+        # Keep logs if debug mode or there were errors; otherwise delete to stay
+        # clean, including a previous run's log so it isn't mistaken for this one.
+        if not (DEBUG_MODE or self.has_errors):
+            self._close()
+            del self.entries[:]
+            stale = [self.log_path]
+            stale.extend(self._backup_path(i) for i in range(1, min(self._rotations, self.backup_count) + 1))
+            for path in stale:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return None
+
         self.entries.append("")
         self.entries.append("=" * 70)
         self.entries.append("Build Summary")
@@ -94,25 +390,10 @@ class BuildLogger:
         self.entries.append("=" * 70)
         self.entries.append("")
 
-        # Always write the log; decide after whether to keep it.
-        try:
-            os.makedirs(self.root_path, exist_ok=True)
-            with open(self.log_path, 'w', encoding='utf-8') as f:
-                f.write("\n".join(self.entries))
-        except Exception:
-            # If we can't write a log, there's nothing else to do here.
-            return None
-
-        # Keep logs if debug mode or there were errors; otherwise delete to stay clean.
-        if DEBUG_MODE or self.has_errors:
-            return self.log_path
+        self.flush()
+        self._close()
 
-        try:
-            os.remove(self.log_path)
-        except Exception:
-            pass
-
-        return None
+        return None if self._write_failed else self.log_path
 
     def get_log_path(self):
         """Return the log path if it exists on disk."""
@@ -127,6 +408,7 @@ class TreeNode:
         self.children = []
         self.parent = parent
         self.comment = comment
+        self._child_index = {}  # name -> first child with that name, kept in sync by add_child
 
     @property
     def is_leaf(self):
@@ -137,6 +419,11 @@ class TreeNode:
         """Add a child node to this node."""
         child.parent = self
         self.children.append(child)
+        self._child_index.setdefault(child.name, child)
+
+    def get_child(self, name):
+        """Return the first child with the given name, or None."""
+        return self._child_index.get(name)
 
     def get_path(self):
         """Get the full path from root to this node."""
@@ -155,13 +442,8 @@ class TreeNode:
 
         # Navigate through parts
         for part in parts[1:]:
-            found = False
-            for child in current.children:
-                if child.name == part:
-                    current = child
-                    found = True
-                    break
-            if not found:
+            current = current.get_child(part)
+            if current is None:
                 return None
 
         return current
@@ -206,137 +488,307 @@ class CommentParser:
         return name_part, comment_part if comment_part else None
 
 
+class DocumentLines:
+    """One-pass classification of every line in a document.
+
+    The text is split and stripped once; TreeDetector, TreeParser and
+    CodeFenceDetector all read from the resulting arrays instead of
+    re-splitting the buffer themselves. `offsets` maps line numbers to
+    positions in the text, for messages that point at a buffer region.
+    """
+
+    BLANK = 0
+    HEADING = 1
+    FENCE = 2
+    TEXT = 3
+
+    # Leading whitespace and box-drawing connectors in front of a tree entry
+    TREE_PREFIX = re.compile(r'[\s│├└─]+')
+
+    def __init__(self, text, lines=None):
+        self.text = text
+        self.lines = text.split('\n') if lines is None else lines
+        self.kinds = bytearray(len(self.lines))
+        self.indents = array('L')        # leading whitespace width
+        self.texts = []                  # stripped line
+        self.tree_indents = array('L')   # width of whitespace + box-drawing prefix
+        self.tree_texts = []             # stripped line without the tree prefix
+        self.fence_lines = []            # indices of fence delimiter lines
+        self.fence_markers = {}          # fence line index -> text after ```
+        self._offsets = None
+
+        self._classify()
+
+    def __len__(self):
+        return len(self.lines)
+
+    @property
+    def offsets(self):
+        """Start position of every line in the text, then one past the end of the text.
+
+        Built on first use, as the stages themselves work on line numbers;
+        line i is text[offsets[i]:offsets[i + 1] - 1].
+        """
+        if self._offsets is None:
+            self._offsets = array('q', accumulate(map((1).__add__, map(len, self.lines)), initial=0))
+        return self._offsets
+
+    def line_at(self, position):
+        """Index of the line holding text position `position`."""
+        return bisect_right(self.offsets, position) - 1
+
+    def line_span(self, start, stop=None):
+        """(begin, end) text positions of lines [start, stop), or of line `start` alone."""
+        offsets = self.offsets
+        stop = min(start + 1 if stop is None else stop, len(self.lines))
+        begin = offsets[start]
+        return begin, max(begin, offsets[stop] - 1)
+
+    def splice(self, text, lines, start, old_stop, new_stop):
+        """Classify `text`, an edited version of this document, reusing unchanged lines.
+
+        `lines` is text split into lines; lines[start:new_stop] replaced this
+        document's lines[start:old_stop] and everything else is unchanged.
+        Only the replaced lines are classified again.
+        """
+        window = DocumentLines(None, lines[start:new_stop])
+        delta = new_stop - old_stop
+
+        doc = DocumentLines.__new__(DocumentLines)
+        doc.text = text
+        doc.lines = lines
+        doc._offsets = None
+        doc.kinds = self.kinds[:start] + window.kinds + self.kinds[old_stop:]
+        doc.indents = self.indents[:start] + window.indents + self.indents[old_stop:]
+        doc.texts = self.texts[:start] + window.texts + self.texts[old_stop:]
+        doc.tree_indents = self.tree_indents[:start] + window.tree_indents + self.tree_indents[old_stop:]
+        doc.tree_texts = self.tree_texts[:start] + window.tree_texts + self.tree_texts[old_stop:]
+
+        fence_lines = self.fence_lines
+        head = fence_lines[:bisect_left(fence_lines, start)]
+        tail = fence_lines[bisect_left(fence_lines, old_stop):]
+        markers = self.fence_markers
+        doc.fence_lines = head + [i + start for i in window.fence_lines] + [i + delta for i in tail]
+        doc.fence_markers = dict((i, markers[i]) for i in head)
+        doc.fence_markers.update((i + start, marker) for i, marker in window.fence_markers.items())
+        doc.fence_markers.update((i + delta, markers[i]) for i in tail)
+        return doc
+
+    def _classify(self):
+        kinds = self.kinds
+        indents = self.indents
+        texts = self.texts
+        tree_indents = self.tree_indents
+        tree_texts = self.tree_texts
+        match_prefix = self.TREE_PREFIX.match
+
+        for i, line in enumerate(self.lines):
+            stripped = line.strip()
+            texts.append(stripped)
+
+            if not stripped:
+                kinds[i] = self.BLANK
+                indents.append(0)
+                tree_indents.append(0)
+                tree_texts.append(stripped)
+                continue
+
+            indent = len(line) - len(line.lstrip())
+            indents.append(indent)
+
+            if stripped.startswith('```'):
+                kinds[i] = self.FENCE
+                self.fence_lines.append(i)
+                self.fence_markers[i] = stripped[3:].strip()
+            elif stripped.startswith('#'):
+                kinds[i] = self.HEADING
+            else:
+                kinds[i] = self.TEXT
+
+            match = match_prefix(line)
+            if match:
+                end = match.end()
+                tree_indents.append(end)
+                # A prefix of plain indentation leaves the stripped line; share it
+                tree_texts.append(stripped if end == indent else line[end:].strip())
+            else:
+                tree_indents.append(0)
+                tree_texts.append(stripped)
+
+
 class CodeFenceDetector:
     """Detects and extracts code fences with filenames."""
 
     @staticmethod
-    def find_code_fences(text, logger=None):
+    def find_code_fences(text, logger=None, doc=None):
         """Find all code fences in text.
 
         Only processes root-level (non-indented) code fences.
         Nested fences inside are preserved in content.
+        Pass `doc` to reuse an existing DocumentLines for the same text.
 
         Returns: list of (filename, content, line_number) tuples
         """
         if logger:
             logger.section("Code Fence Detection")
 
-        lines = text.split('\n')
-        fences = []
-        i = 0
+        doc = doc or DocumentLines(text)
+        spans = []
+        CodeFenceDetector.scan(doc, logger, spans=spans)
+        fences = [fence for _, _, fence in spans if fence]
 
-        while i < len(lines):
-            line = lines[i]
+        if logger:
+            logger.info("Total fences detected: {0}", len(fences))
 
-            # Check if this is a root-level fence (no leading whitespace)
-            stripped = line.strip()
-            indent_level = len(line) - len(stripped)
+        return fences
 
-            # Only process non-indented fences
-            if indent_level == 0 and stripped.startswith('```'):
-                if logger:
-                    logger.info("Found root-level fence at line {0}".format(i), "Line content: {0}".format(line[:50]))
-
-                filename = None
-                fence_start = i
-
-                # Strategy 1: Check line before fence (pre-fence)
-                if i > 0:
-                    prev_line = lines[i - 1].strip()
-                    if prev_line and not prev_line.startswith('```'):
-                        potential_name = CodeFenceDetector._extract_filename(prev_line)
-                        if potential_name:
-                            filename = potential_name
-                            if logger:
-                                logger.info("Filename from pre-fence", "Filename: {0}".format(filename))
-
-                # Strategy 2: Check on the fence line (on-fence)
-                if not filename:
-                    fence_content = stripped[3:].strip()  # Remove ``` and trim
-                    if fence_content:
-                        # Try to extract - let _extract_filename handle validation
-                        potential_name = CodeFenceDetector._extract_filename(fence_content)
-                        if potential_name:
-                            filename = potential_name
-                            if logger:
-                                logger.info("Filename from on-fence", "Filename: {0}".format(filename))
-
-                # Find fence end and content (handle nested fences)
-                i += 1
-                content_lines = []
-                nesting_level = 0  # Track nested fences
-
-                while i < len(lines):
-                    current_line = lines[i]
-                    current_stripped = current_line.strip()
-                    current_indent = len(current_line) - len(current_stripped)
-
-                    # Check if this line is a fence delimiter
-                    if current_stripped.startswith('```'):
-                        fence_marker = current_stripped[3:].strip()
-
-                        # Determine if this is opening or closing
-                        # Opening: has marker (```python, ```json, etc.) OR is indented
-                        # Closing: no marker (just ```) AND at root level (indent == 0)
-
-                        is_opening = fence_marker != '' or current_indent > 0
-                        is_closing = fence_marker == '' and current_indent == 0
-
-                        if is_opening:
-                            # This is a nested/indented fence opening
-                            nesting_level += 1
-                            content_lines.append(current_line)
-                            if logger:
-                                logger.info("Nested fence opened at line {0}".format(i), 
-                                          "Marker: '{0}', indent: {1}, level: {2}".format(fence_marker, current_indent, nesting_level))
-                        elif is_closing:
-                            # Root-level closing fence
-                            if nesting_level > 0:
-                                # We're still inside nested content
-                                nesting_level -= 1
-                                content_lines.append(current_line)
-                                if logger:
-                                    logger.info("Nested fence closed at line {0}".format(i), "Level: {0}".format(nesting_level))
-                            else:
-                                # This closes our fence
-                                if logger:
-                                    logger.info("Root fence closed at line {0}".format(i))
-                                break
-                        else:
-                            # Shouldn't happen but include it
-                            content_lines.append(current_line)
-                    else:
-                        # Regular content line
-                        content_lines.append(current_line)
-
-                    i += 1
-
-                # Strategy 3: Check first line of content (post-fence)
-                if not filename and content_lines:
-                    first_line = content_lines[0].strip()
-                    if first_line:
-                        potential_name = CodeFenceDetector._extract_filename_from_comment(first_line)
-                        if potential_name:
-                            filename = potential_name
-                            # Remove the filename line from content
-                            content_lines = content_lines[1:]
-                            if logger:
-                                logger.info("Filename from post-fence", "Filename: {0}".format(filename))
-
-                if filename:
-                    content = '\n'.join(content_lines)
-                    fences.append((filename, content, fence_start))
-                    if logger:
-                        logger.info("Code fence added", "{0} ({1} chars)".format(filename, len(content)))
-                elif logger:
-                    logger.warning("Code fence at line {0} has no filename".format(fence_start), "Skipping")
+    @staticmethod
+    def iter_code_fences(text, logger=None, doc=None):
+        """Yield the code fences of text one at a time, each as soon as it closes.
 
-            i += 1
+        Like find_code_fences(), but only the fence being read is held in
+        memory: a caller that writes each fence before asking for the next
+        never holds the code of the whole document at once.
 
+        Yields: (filename, content, line_number) tuples
+        """
         if logger:
-            logger.info("Total fences detected: {0}".format(len(fences)))
+            logger.section("Code Fence Detection")
 
-        return fences
+        doc = doc or DocumentLines(text)
+        count = 0
+        for _, _, fence in CodeFenceDetector.iter_spans(doc, logger):
+            if fence:
+                count += 1
+                yield fence
+
+        if logger:
+            logger.info("Total fences detected: {0}", count)
+
+    @staticmethod
+    def scan(doc, logger=None, start_line=0, stop_line=None, spans=None):
+        """Scan the root-level fences that open in lines [start_line, stop_line).
+
+        Appends (fence_start, fence_end, fence) to `spans` for every root
+        fence, where fence is the (filename, content, line_number) tuple or
+        None for a fence without a filename. A fence opened before stop_line
+        is followed to its end even if that lies beyond stop_line.
+
+        Returns: index of the first line after the last fence scanned
+        """
+        if spans is None:
+            spans = []
+        next_line = start_line
+        for span in CodeFenceDetector.iter_spans(doc, logger, start_line, stop_line):
+            spans.append(span)
+            next_line = span[1] + 1
+        return next_line
+
+    @staticmethod
+    def iter_spans(doc, logger=None, start_line=0, stop_line=None):
+        """Yield the (fence_start, fence_end, fence) spans scan() collects, as they close."""
+        lines = doc.lines
+        texts = doc.texts
+        indents = doc.indents
+        markers = doc.fence_markers
+        fence_lines = doc.fence_lines
+        k = bisect_left(fence_lines, start_line)
+
+        # Only fence delimiter lines can open or close a fence, so walk those
+        # and take the content as the slice of lines in between.
+        while k < len(fence_lines):
+            i = fence_lines[k]
+            if stop_line is not None and i >= stop_line:
+                break
+            k += 1
+
+            # Only process non-indented fences
+            if indents[i] != 0:
+                continue
+
+            if logger:
+                logger.debug("Found root-level fence at line {0}", i, context=("Line content: {0}", lines[i][:50]))
+
+            filename = None
+            fence_start = i
+
+            # Strategy 1: Check line before fence (pre-fence)
+            if i > 0:
+                prev_line = texts[i - 1]
+                if prev_line and doc.kinds[i - 1] != DocumentLines.FENCE:
+                    potential_name = CodeFenceDetector._extract_filename(prev_line)
+                    if potential_name:
+                        filename = potential_name
+                        if logger:
+                            logger.debug("Filename from pre-fence", context=("Filename: {0}", filename))
+
+            # Strategy 2: Check on the fence line (on-fence)
+            if not filename:
+                fence_content = markers[i]  # Text after ```, trimmed
+                if fence_content:
+                    # Try to extract - let _extract_filename handle validation
+                    potential_name = CodeFenceDetector._extract_filename(fence_content)
+                    if potential_name:
+                        filename = potential_name
+                        if logger:
+                            logger.debug("Filename from on-fence", context=("Filename: {0}", filename))
+
+            # Find fence end (handle nested fences)
+            fence_end = len(lines)
+            nesting_level = 0  # Track nested fences
+
+            while k < len(fence_lines):
+                j = fence_lines[k]
+                fence_marker = markers[j]
+                current_indent = indents[j]
+
+                # Determine if this is opening or closing
+                # Opening: has marker (```python, ```json, etc.) OR is indented
+                # Closing: no marker (just ```) AND at root level (indent == 0)
+                if fence_marker != '' or current_indent > 0:
+                    # This is a nested/indented fence opening
+                    nesting_level += 1
+                    if logger:
+                        logger.debug("Nested fence opened at line {0}", j,
+                                     context=("Marker: '{0}', indent: {1}, level: {2}", fence_marker, current_indent, nesting_level))
+                elif nesting_level > 0:
+                    # Root-level closing fence, but we're still inside nested content
+                    nesting_level -= 1
+                    if logger:
+                        logger.debug("Nested fence closed at line {0}", j, context=("Level: {0}", nesting_level))
+                else:
+                    # This closes our fence
+                    fence_end = j
+                    k += 1
+                    if logger:
+                        logger.debug("Root fence closed at line {0}", j)
+                    break
+                k += 1
+
+            content_start = fence_start + 1
+
+            # Strategy 3: Check first line of content (post-fence)
+            if not filename and content_start < fence_end:
+                first_line = texts[content_start]
+                if first_line:
+                    potential_name = CodeFenceDetector._extract_filename_from_comment(first_line)
+                    if potential_name:
+                        filename = potential_name
+                        # Remove the filename line from content
+                        content_start += 1
+                        if logger:
+                            logger.debug("Filename from post-fence", context=("Filename: {0}", filename))
+
+            fence = None
+            if filename:
+                content = '\n'.join(lines[content_start:fence_end])
+                fence = (filename, content, fence_start)
+                if logger:
+                    logger.debug("Code fence added", context=("{0} ({1} chars)", filename, len(content)))
+            elif logger:
+                logger.warning("Code fence at line {0} has no filename", fence_start, context="Skipping")
+
+            yield fence_start, fence_end, fence
 
     @staticmethod
     def _extract_filename(text):
@@ -411,6 +863,11 @@ class CodeFenceDetector:
         return None
 
 
+def _minimal_keywords(keywords):
+    """Drop keywords that contain another keyword; the shorter one matches the same lines."""
+    return tuple(k for k in keywords if not any(other != k and other in k for other in keywords))
+
+
 class TreeDetector:
     """Detects where the file tree starts in a document."""
 
@@ -419,35 +876,124 @@ class TreeDetector:
         'directory structure', 'folder structure', 'project structure'
     ]
 
+    # Words whose presence marks a structure line ("## Structure", "# File Tree:", ...)
+    MARKER_WORDS = _minimal_keywords(STRUCTURE_KEYWORDS)
+
+    # Any line kind other than DocumentLines.BLANK (0)
+    NONBLANK_PATTERN = re.compile(b'[^\x00]')
+
+    # Characters lowercased at a time while searching for markers
+    MARKER_CHUNK = 1 << 20
+
     @staticmethod
-    def find_tree_start(text):
+    def find_tree_start(text, doc=None):
         """Find where the tree structure starts in the text.
 
+        Pass `doc` to reuse an existing DocumentLines for the same text.
+
         Returns: (start_line_index, end_line_index_or_none)
         """
-        lines = text.split('\n')
-
-        # Strategy 1: Look for explicit structure markers
-        for i, line in enumerate(lines):
-            line_lower = line.lower().strip()
-
-            # Check for markers like "## Structure", "# File Tree:", etc.
-            for keyword in TreeDetector.STRUCTURE_KEYWORDS:
-                if keyword in line_lower:
-                    # Tree starts on next non-empty line
-                    for j in range(i + 1, len(lines)):
-                        if lines[j].strip():
-                            return j, TreeDetector._find_tree_end(lines, j)
+        doc = doc or DocumentLines(text)
+        kinds = doc.kinds
+        nonblank = TreeDetector.NONBLANK_PATTERN
+
+        # Strategy 1: the tree starts on the first non-empty line after the
+        # first structure marker. No marker can follow a marker line with
+        # nothing after it, so only the first one matters.
+        line = next(TreeDetector._marker_lines(text), None)
+        if line is not None:
+            start = nonblank.search(kinds, line + 1)
+            if start:
+                return start.start(), TreeDetector._find_tree_end(doc, start.start())
 
         # Strategy 2: Assume tree starts at first non-empty line
-        for i, line in enumerate(lines):
-            if line.strip():
-                return i, TreeDetector._find_tree_end(lines, i)
+        start = nonblank.search(kinds)
+        if start:
+            return start.start(), TreeDetector._find_tree_end(doc, start.start())
 
         return 0, None
 
     @staticmethod
-    def _find_tree_end(lines, start_idx):
+    def find_tree_regions(text, doc=None, spans=None):
+        """Find every tree in the text, for documents with one tree per section.
+
+        The first tree is the one find_tree_start() finds. Every markdown
+        heading with a structure marker after its first line ("## Backend
+        Structure") ends the tree before it and starts another. Headings
+        inside the code fences in `spans` (CodeFenceDetector.scan() spans)
+        don't count.
+
+        Returns: list of (start_line_index, stop_line_index) ranges, in order
+        """
+        doc = doc or DocumentLines(text)
+        kinds = doc.kinds
+        nonblank = TreeDetector.NONBLANK_PATTERN
+        spans = spans or []
+        fence_starts = [span[0] for span in spans]
+
+        start, end = TreeDetector.find_tree_start(text, doc)
+        regions = [[start, len(kinds) if end is None else min(end, len(kinds))]]
+
+        for line in TreeDetector._marker_lines(text):
+            region = regions[-1]
+            if line <= region[0] or kinds[line] != DocumentLines.HEADING:
+                continue
+            k = bisect_right(fence_starts, line) - 1
+            if k >= 0 and spans[k][1] >= line:
+                continue  # A comment line inside a code fence
+
+            region[1] = min(region[1], line)
+            found = nonblank.search(kinds, line + 1)
+            if not found:
+                break
+            start = found.start()
+            end = TreeDetector._find_tree_end(doc, start)
+            regions.append([start, len(kinds) if end is None else min(end, len(kinds))])
+
+        return [tuple(region) for region in regions]
+
+    @staticmethod
+    def _marker_lines(text):
+        """Yield the index of every line of text with a structure marker, in order.
+
+        The text is lowercased and searched with str.find (faster than a
+        line-by-line scan or a case-insensitive regex) a chunk at a time, so
+        no lowercase copy of a large document is made, and a marker near the
+        top is found without reading further.
+        """
+        words = TreeDetector.MARKER_WORDS
+        size = TreeDetector.MARKER_CHUNK
+        overlap = max(len(word) for word in words) - 1
+        last = -1
+        chunk_line = 0  # Index of the line holding text[start]
+
+        for start in range(0, len(text), size):
+            # Overlapping chunks catch markers across the boundary; lines
+            # found twice are only yielded once
+            lowered = text[start:start + size + overlap].lower()
+            hits = [lowered.find(word) for word in words]
+            line = chunk_line
+            pos = 0
+            while True:
+                found = [hit for hit in hits if hit >= 0]
+                if not found:
+                    break
+                hit = min(found)
+                line += lowered.count('\n', pos, hit)
+                if line > last:
+                    last = line
+                    yield line
+
+                # Continue from the next line
+                pos = lowered.find('\n', hit)
+                if pos < 0:
+                    break
+                hits = [lowered.find(word, pos) if 0 <= other < pos else other
+                        for word, other in zip(words, hits)]
+            chunk_line += text.count('\n', start, start + size)
+
+    @staticmethod
+    def _find_tree_end(doc, start_idx):
         """Find where the tree likely ends.
 
         Returns: line index where tree ends, or None if unclear
@@ -457,19 +1003,20 @@ class TreeDetector:
         # - A markdown heading (if we've seen at least a few tree lines)
         # - Multiple consecutive empty lines
 
+        kinds = doc.kinds
         tree_line_count = 0
         empty_line_count = 0
 
-        for i in range(start_idx, len(lines)):
-            line = lines[i].strip()
+        for i in range(start_idx, len(kinds)):
+            kind = kinds[i]
 
             # Code fence detected
-            if line.startswith('```'):
+            if kind == DocumentLines.FENCE:
                 if tree_line_count > 0:
                     return i
 
             # Empty line
-            if not line:
+            if kind == DocumentLines.BLANK:
                 empty_line_count += 1
                 if empty_line_count >= 3:  # Multiple empty lines
                     return i
@@ -478,12 +1025,43 @@ class TreeDetector:
                 tree_line_count += 1
 
             # Markdown heading (after we've seen some tree)
-            if tree_line_count > 3 and line.startswith('#'):
+            if tree_line_count > 3 and kind == DocumentLines.HEADING:
                 return i
 
         return None  # Tree goes to end of document
 
 
+# Unicode ranges treated as emoji when sanitizing names
+EMOJI_RANGES = (
+    "\U0001F600-\U0001F64F"  # emoticons
+    "\U0001F300-\U0001F5FF"  # symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # transport & map symbols
+    "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    "\U00002702-\U000027B0"  # dingbats
+    "\U000024C2-\U0001F251"  # enclosed characters
+    "\U0001F900-\U0001F9FF"  # supplemental symbols
+    "\U0001FA00-\U0001FA6F"  # chess symbols
+    "\U0001FA70-\U0001FAFF"  # symbols and pictographs extended-a
+    "\U00002600-\U000026FF"  # miscellaneous symbols
+    "\U00002700-\U000027BF"  # dingbats
+)
+
+# Default number of threads writing file bodies during a build
+DEFAULT_MAX_WORKERS = 8
+
+# Entries skipped when framing a directory back into a spec
+DEFAULT_FRAME_IGNORE = [
+    '.git', '.hg', '.svn', '__pycache__', 'node_modules', '.DS_Store', '.handeeframer',
+    'handeeframer_log*.txt', TRACE_FILENAME,
+]
+
+# Files up to this size are inlined as code fences when framing a directory
+DEFAULT_FRAME_INLINE_MAX_BYTES = 4096
+
+# Number of distinct raw names TreeParser.sanitize_filename remembers
+SANITIZE_CACHE_SIZE = 4096
+
+
 class TreeParser:
     """Parses text representation of file trees into TreeNode structures."""
 
@@ -498,62 +1076,52 @@ class TreeParser:
     # Control characters (0-31) and DEL (127)
     CONTROL_CHARS = set(chr(i) for i in range(32)) | {chr(127)}
 
-    def __init__(self, text, start_line=0, end_line=None):
-        """Initialize parser with text and optional line range."""
+    # Emoji pattern - covers most emoji ranges
+    EMOJI_PATTERN = re.compile("[" + EMOJI_RANGES + "]+", flags=re.UNICODE)
+
+    # Everything sanitize_filename removes (emojis, box-drawing, invalid and
+    # control characters) as a single character class, compiled once
+    REMOVE_PATTERN = re.compile(
+        "[" + EMOJI_RANGES
+        + "".join(re.escape(c) for c in sorted(BOX_CHARS | WINDOWS_INVALID | CONTROL_CHARS))
+        + "]+",
+        flags=re.UNICODE
+    )
+    WHITESPACE_PATTERN = re.compile(r'\s+')
+
+    def __init__(self, text, start_line=0, end_line=None, doc=None):
+        """Initialize parser with text and optional line range.
+
+        Pass `doc` to reuse an existing DocumentLines for the same text.
+        """
         self.text = text
-        all_lines = text.split('\n')
+        self.doc = doc or DocumentLines(text)
 
-        # Extract only the tree portion
-        if end_line is None:
-            self.lines = all_lines[start_line:]
-        else:
-            self.lines = all_lines[start_line:end_line]
+        # Only the tree portion is parsed
+        self.start_line = start_line
+        self.end_line = len(self.doc) if end_line is None else min(end_line, len(self.doc))
+        self._root_index = {}
 
     @staticmethod
     def remove_emojis(text):
         """Remove all emoji characters from text."""
-        # Emoji pattern - covers most emoji ranges
-        emoji_pattern = re.compile(
-            "["
-            "\U0001F600-\U0001F64F"  # emoticons
-            "\U0001F300-\U0001F5FF"  # symbols & pictographs
-            "\U0001F680-\U0001F6FF"  # transport & map symbols
-            "\U0001F1E0-\U0001F1FF"  # flags (iOS)
-            "\U00002702-\U000027B0"  # dingbats
-            "\U000024C2-\U0001F251"  # enclosed characters
-            "\U0001F900-\U0001F9FF"  # supplemental symbols
-            "\U0001FA00-\U0001FA6F"  # chess symbols
-            "\U0001FA70-\U0001FAFF"  # symbols and pictographs extended-a
-            "\U00002600-\U000026FF"  # miscellaneous symbols
-            "\U00002700-\U000027BF"  # dingbats
-            "]+",
-            flags=re.UNICODE
-        )
-        return emoji_pattern.sub('', text)
+        return TreeParser.EMOJI_PATTERN.sub('', text)
 
     @staticmethod
+    @lru_cache(maxsize=SANITIZE_CACHE_SIZE)
     def sanitize_filename(name):
-        """Clean filename to be OS-compatible (but preserve slashes for paths)."""
-        # Remove emojis
-        name = TreeParser.remove_emojis(name)
-
-        # Remove box-drawing characters
-        for char in TreeParser.BOX_CHARS:
-            name = name.replace(char, '')
-
-        # Remove Windows-invalid characters (except slashes which we handle separately)
-        for char in TreeParser.WINDOWS_INVALID:
-            name = name.replace(char, '')
+        """Clean filename to be OS-compatible (but preserve slashes for paths).
 
-        # Remove control characters
-        for char in TreeParser.CONTROL_CHARS:
-            name = name.replace(char, '')
+        Memoized: generated trees repeat the same names many times over.
+        """
+        # Remove emojis, box-drawing, Windows-invalid and control characters
+        name = TreeParser.REMOVE_PATTERN.sub('', name)
 
         # Strip whitespace
         name = name.strip()
 
         # Replace multiple spaces with single space
-        name = re.sub(r'\s+', ' ', name)
+        name = TreeParser.WHITESPACE_PATTERN.sub(' ', name)
 
         return name
 
@@ -581,19 +1149,20 @@ class TreeParser:
         """Parse the text and return a list of root nodes."""
         nodes = []
         stack = []  # (indent_level, node)
+        self._root_index = {}  # name -> first root node with that name
 
-        for line in self.lines:
-            if not line.strip():
-                continue
-
-            # Clean the line - remove box-drawing characters and get indent
-            cleaned_line, indent = self.clean_line_prefix(line)
+        # Lines come pre-cleaned: box-drawing prefix removed, indent measured
+        tree_texts = self.doc.tree_texts
+        tree_indents = self.doc.tree_indents
 
-            if not cleaned_line.strip():
+        for i in range(self.start_line, self.end_line):
+            cleaned_line = tree_texts[i]
+            if not cleaned_line:
                 continue
+            indent = tree_indents[i]
 
             # Extract comment from the line
-            name_part, comment = CommentParser.extract_comment(cleaned_line.strip())
+            name_part, comment = CommentParser.extract_comment(cleaned_line)
 
             if not name_part:
                 continue
@@ -647,25 +1216,18 @@ class TreeParser:
             parent_node = stack[-1][1]
 
         # Find or create the root
-        root = None
         if parent_node:
-            for child in parent_node.children:
-                if child.name == cleaned_parts[0]:
-                    root = child
-                    break
+            root = parent_node.get_child(cleaned_parts[0])
             if root is None:
                 root_comment = comment if len(cleaned_parts) == 1 else None
                 root = TreeNode(cleaned_parts[0], comment=root_comment)
                 parent_node.add_child(root)
         else:
-            for node in nodes:
-                if node.name == cleaned_parts[0]:
-                    root = node
-                    break
+            root = self._root_index.get(cleaned_parts[0])
             if root is None:
                 root_comment = comment if len(cleaned_parts) == 1 else None
                 root = TreeNode(cleaned_parts[0], comment=root_comment)
-                nodes.append(root)
+                self._add_root(root, nodes)
 
         # Build the path
         current = root
@@ -675,11 +1237,7 @@ class TreeParser:
             node_comment = comment if is_last else None
 
             # Look for existing child
-            child = None
-            for c in current.children:
-                if c.name == part:
-                    child = c
-                    break
+            child = current.get_child(part)
 
             if child is None:
                 child = TreeNode(part, comment=node_comment)
@@ -713,75 +1271,1151 @@ class TreeParser:
             parent = stack[-1][1]
             parent.add_child(node)
         else:
-            nodes.append(node)
+            self._add_root(node, nodes)
 
         # Add to stack so it can be a potential parent
         stack.append((indent, node))
 
+    def _add_root(self, node, nodes):
+        """Append a root node and index it by name for shorthand merging."""
+        nodes.append(node)
+        self._root_index.setdefault(node.name, node)
+
+
+class ParseCache:
+    """Parse results of the previous build of a buffer, reused by the next one.
+
+    parse() compares the new text against the previous one line by line and
+    only re-does the work the edit invalidated: the changed lines are
+    classified again, the tree is parsed again only if its lines changed,
+    and code fences before and after the edit are carried over. Pass a `key`
+    that changes whenever the text does (the view's change count) to reuse
+    everything for an unchanged buffer without comparing lines.
+
+    One cache serves one buffer, and one build at a time.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.doc = None
+        self.all_trees = False  # Whether self.trees holds every tree or just the first
+        self.trees = None  # [((start, stop) line range, nodes, fences)] per tree
+        self.spans = None  # CodeFenceDetector.scan() spans of self.doc
+
+    # Lines compared per slice while looking for the changed window
+    COMPARE_CHUNK = 1024
+
+    @staticmethod
+    def _changed_window(old_lines, new_lines):
+        """Return (start, old_stop, new_stop) bounding the lines that differ."""
+        chunk = ParseCache.COMPARE_CHUNK
+        limit = min(len(old_lines), len(new_lines))
+
+        # Skip equal chunks with slice comparisons, then find the line
+        start = 0
+        while start + chunk <= limit and old_lines[start:start + chunk] == new_lines[start:start + chunk]:
+            start += chunk
+        while start < limit and old_lines[start] == new_lines[start]:
+            start += 1
+
+        old_stop = len(old_lines)
+        new_stop = len(new_lines)
+        while (min(old_stop, new_stop) - chunk >= start
+               and old_lines[old_stop - chunk:old_stop] == new_lines[new_stop - chunk:new_stop]):
+            old_stop -= chunk
+            new_stop -= chunk
+        while old_stop > start and new_stop > start and old_lines[old_stop - 1] == new_lines[new_stop - 1]:
+            old_stop -= 1
+            new_stop -= 1
+        return start, old_stop, new_stop
+
+    def parse(self, text, key=None, logger=None, progress=None, trace=None):
+        """Detect and parse the tree and code fences of `text`.
+
+        Returns: (root nodes, list of (filename, content, line_number) fences)
+        """
+        return self.parse_trees(text, key, logger, progress, trace)[0]
+
+    def parse_trees(self, text, key=None, logger=None, progress=None, trace=None,
+                    all_trees=False):
+        """Detect and parse the trees and code fences of `text`.
+
+        Only the first tree is parsed unless `all_trees` is set; see
+        TreeDetector.find_tree_regions(). A fence goes with the last tree that
+        starts before it (the first tree if none does), unless that tree
+        doesn't list the fence's file and another one does: then it goes with
+        the first tree listing it. So a shared "Files" section after all the
+        trees still fills each of them.
+
+        Returns: list of (root nodes, fences) per tree, in document order
+        """
+        logger = logger or BuildLogger(os.getcwd(), stream=False)
+        progress = progress or BuildProgress()
+        trace = trace or BuildTrace()
+        old = self.doc
+
+        if (old is not None and key is not None and key == self.key and text == old.text
+                and all_trees == self.all_trees):
+            logger.info("Buffer unchanged since the last build, reusing its parse")
+            trace.update(lines=len(old),
+                         nodes=sum(count_nodes(nodes) for _, nodes, _ in self.trees),
+                         fences=sum(len(fences) for _, _, fences in self.trees))
+            return [(nodes, fences) for _, nodes, fences in self.trees]
+
+        # Classify every line once; all stages below share the result
+        window = None
+        with trace.phase('tokenize'):
+            if old is None:
+                doc = DocumentLines(text)
+            else:
+                lines = text.split('\n')
+                window = self._changed_window(old.lines, lines)
+                doc = old.splice(text, lines, *window)
+        if window:
+            logger.info("Lines changed since the last build: {0} to {1}", window[0], window[2])
+        trace.update(lines=len(doc))
+
+        # Detect tree start and end
+        progress.update("Detecting tree", force=True)
+        logger.section("Tree Detection")
+        with trace.phase('detect'):
+            tree_start, tree_end = TreeDetector.find_tree_start(text, doc)
+        logger.info("Tree range: lines {0} to {1}", tree_start, tree_end)
+        tree_stop = len(doc) if tree_end is None else min(tree_end, len(doc))
+
+        # Parse the tree, unless its lines are the ones parsed last time
+        progress.update("Parsing tree", force=True)
+        logger.section("Tree Parsing")
+        previous = [(old.lines, tree_range, nodes) for tree_range, nodes, _ in self.trees] if old else []
+        with trace.phase('parse'):
+            nodes = self._parse_tree(doc, (tree_start, tree_stop), previous[:1], logger)
+        trace.update(nodes=count_nodes(nodes))
+
+        # Detect code fences
+        progress.update("Scanning code fences", force=True)
+        logger.section("Code Fence Detection")
+        with trace.phase('fences'):
+            spans, reused = self._scan_fences(doc, logger, window)
+        code_fences = [fence for _, _, fence in spans if fence]
+        logger.info("Total fences detected: {0}", len(code_fences))
+        if reused:
+            logger.info("Fences reused from the last build: {0} of {1}", reused, len(spans))
+        trace.update(fences=len(code_fences))
+
+        trees = [((tree_start, tree_stop), nodes)]
+        if all_trees:
+            trees = self._parse_more_trees(text, doc, spans, trees, previous, logger, progress, trace)
+
+        # Hand each fence to the last tree starting before it, or to a tree listing its file
+        starts = [tree_range[0] for tree_range, _ in trees]
+        groups = [[] for _ in trees]
+        listed = [self._tree_paths(nodes) for _, nodes in trees] if len(trees) > 1 else None
+        for fence in code_fences:
+            index = max(0, bisect_right(starts, fence[2]) - 1)
+            if listed and not self._lists(listed[index], fence[0]):
+                index = next((other for other, paths in enumerate(listed)
+                              if self._lists(paths, fence[0])), index)
+            groups[index].append(fence)
+
+        self.key = key
+        self.doc = doc
+        self.all_trees = all_trees
+        self.trees = [(tree_range, nodes, fences) for (tree_range, nodes), fences in zip(trees, groups)]
+        self.spans = spans
+        return [(nodes, fences) for (_, nodes), fences in zip(trees, groups)]
+
+    @staticmethod
+    def _tree_paths(nodes):
+        """Return (relative paths, names) of a tree's entries, as TreeBuilder indexes them.
+
+        Paths are relative to the root the tree is built in: its single root
+        node's folder, or the base folder when it has several.
+        """
+        if len(nodes) == 1:
+            nodes = [] if nodes[0].is_leaf else nodes[0].children
+        relpaths = set()
+        names = set()
+        pending = [(node, node.name) for node in nodes]
+        while pending:
+            node, relpath = pending.pop()
+            relpaths.add(relpath)
+            names.add(node.name)
+            pending.extend((child, relpath + '/' + child.name) for child in node.children)
+        return relpaths, names
+
+    @staticmethod
+    def _lists(paths, filename):
+        """Whether a tree with _tree_paths() `paths` has the file a fence labelled filename fills."""
+        relpaths, names = paths
+        if '/' in filename or '\\' in filename:
+            return TreeBuilder._normalize_relpath(filename) in relpaths
+        return filename in names
+
+    def _parse_more_trees(self, text, doc, spans, trees, previous, logger, progress, trace):
+        """Find the trees after the first and parse them; return [(range, nodes)] for all."""
+        progress.update("Detecting more trees", force=True)
+        logger.section("Tree Detection (all trees)")
+        with trace.phase('detect'):
+            regions = TreeDetector.find_tree_regions(text, doc, spans)
+        logger.info("Trees found: {0}", len(regions))
+
+        # The first tree is parsed already, unless a later heading cut it short
+        parsed = dict(trees)
+        with trace.phase('parse'):
+            for index, region in enumerate(regions):
+                if region in parsed:
+                    continue
+                logger.info("Tree {0}: lines {1} to {2}", index + 1, region[0], region[1])
+                parsed[region] = self._parse_tree(doc, region, previous[index:index + 1], logger)
+        trace.update(trees=len(regions), nodes=sum(count_nodes(parsed[region]) for region in regions))
+        return [(region, parsed[region]) for region in regions]
+
+    @staticmethod
+    def _parse_tree(doc, tree_range, previous, logger):
+        """Parse the tree in lines tree_range of doc.
+
+        `previous` lists (lines, tree_range, nodes) of earlier parses; nodes
+        parsed from the same lines are reused instead of parsing again.
+        """
+        start, stop = tree_range
+        for lines, (old_start, old_stop), nodes in previous:
+            if old_stop - old_start == stop - start and lines[old_start:old_stop] == doc.lines[start:stop]:
+                logger.info("Tree unchanged since the last build, reusing its nodes")
+                return nodes
+        return TreeParser(doc.text, start_line=start, end_line=stop, doc=doc).parse()
+
+    def _scan_fences(self, doc, logger, window):
+        """Scan the fences of `doc`, carrying over those the edit in `window` left alone.
+
+        Returns: (spans, number of spans reused)
+        """
+        spans = []
+        if window is None:
+            CodeFenceDetector.scan(doc, logger, spans=spans)
+            return spans, 0
+
+        start, old_stop, new_stop = window
+        delta = new_stop - old_stop
+        old_spans = self.spans
+
+        # Fences that close before the first changed line are unchanged
+        head = 0
+        while head < len(old_spans) and old_spans[head][1] < start:
+            head += 1
+        spans.extend(old_spans[:head])
+        line = old_spans[head - 1][1] + 1 if head else 0
+
+        # A fence opening after the edit (name line included) is unchanged, as
+        # is everything after it, once the rescan reaches it outside any fence
+        tail = head
+        while tail < len(old_spans) and old_spans[tail][0] - 1 < old_stop:
+            tail += 1
+
+        while tail < len(old_spans):
+            target = old_spans[tail][0] + delta
+            if target >= line:
+                line = CodeFenceDetector.scan(doc, logger, line, target, spans)
+                if line <= target:
+                    for fence_start, fence_end, fence in old_spans[tail:]:
+                        if fence:
+                            fence = (fence[0], fence[1], fence[2] + delta)
+                        spans.append((fence_start + delta, fence_end + delta, fence))
+                    return spans, head + len(old_spans) - tail
+            tail += 1
+
+        CodeFenceDetector.scan(doc, logger, line, spans=spans)
+        return spans, head
+
+
+class DirectorySnapshot:
+    """Per-build table of which paths exist, filled by one listing per directory.
+
+    A directory is read with os.scandir the first time anything inside it is
+    queried. Paths the build plans to create are recorded with add_dir() and
+    add_file(), so later queries see the tree as it will be.
+    """
+
+    def __init__(self):
+        self._listings = {}  # normcased directory -> {normcased name: is_dir}, None if missing
+        self.reads = 0
+        self.offline = False  # Never read the disk; unknown directories are missing
+
+    @classmethod
+    def offline_at(cls, base_path):
+        """A snapshot of an empty tree under base_path, for builds that don't go to disk."""
+        snapshot = cls()
+        snapshot.offline = True
+        path = os.path.normpath(base_path)
+        while True:
+            snapshot._listings[os.path.normcase(path)] = {}
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return snapshot
+
+    def _listing(self, directory):
+        """Return the cached listing of directory, reading it on first use."""
+        key = os.path.normcase(directory)
+        if key in self._listings:
+            return self._listings[key]
+
+        # Children of a directory known to be missing are missing too
+        parent = os.path.dirname(directory)
+        parent_key = os.path.normcase(parent)
+        if parent != directory and parent_key in self._listings:
+            parent_listing = self._listings[parent_key]
+            if parent_listing is None or parent_listing.get(
+                    os.path.normcase(os.path.basename(directory))) is not True:
+                self._listings[key] = None
+                return None
+
+        listing = None
+        if self.offline:
+            self._listings[key] = None
+            return None
+        try:
+            self.reads += 1
+            listing = {}
+            for entry in os.scandir(directory):
+                try:
+                    listing[os.path.normcase(entry.name)] = entry.is_dir()
+                except OSError:
+                    listing[os.path.normcase(entry.name)] = False
+        except OSError:
+            listing = None
+
+        self._listings[key] = listing
+        return listing
+
+    def exists(self, path):
+        """Whether path exists (or is planned)."""
+        if self._listings.get(os.path.normcase(path)) is not None:
+            return True  # A directory we have already listed
+        listing = self._listing(os.path.dirname(path))
+        return listing is not None and os.path.normcase(os.path.basename(path)) in listing
+
+    def is_dir(self, path):
+        """Whether path is (or is planned to be) a directory."""
+        if self._listings.get(os.path.normcase(path)) is not None:
+            return True
+        listing = self._listing(os.path.dirname(path))
+        return listing is not None and listing.get(os.path.normcase(os.path.basename(path))) is True
+
+    def add_dir(self, path):
+        """Record a directory as created; it starts out empty."""
+        self._record(path, True)
+        self._listings[os.path.normcase(path)] = {}
+
+    def add_file(self, path):
+        """Record a file as created."""
+        self._record(path, False)
+
+    def _record(self, path, is_dir):
+        listing = self._listing(os.path.dirname(path))
+        if listing is None:
+            listing = self._listings[os.path.normcase(os.path.dirname(path))] = {}
+        listing[os.path.normcase(os.path.basename(path))] = is_dir
+
+
+class BuildManifest:
+    """Record of the files HandeeFramer wrote under a root, kept between builds.
+
+    Each entry holds a file's size and mtime right after it was written and a
+    hash of its text. While size and mtime still match, the file is our own
+    unmodified output and the hash tells what it holds, so one stat replaces
+    reading it. Stored in <root>/.handeeframer/manifest.json.
+    """
+
+    DIRECTORY = '.handeeframer'
+    FILENAME = 'manifest.json'
+    VERSION = 1
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.path = os.path.join(root_path, self.DIRECTORY, self.FILENAME)
+        self.entries = {}  # 'a/b/c' path relative to root -> {'size', 'mtime_ns', 'sha1'}
+        self.changed = False
+
+    @classmethod
+    def load(cls, root_path):
+        """Load the manifest under root_path; a missing or unreadable one is empty."""
+        manifest = cls(root_path)
+        try:
+            with open(manifest.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == cls.VERSION:
+                manifest.entries = data.get('files', {})
+        except (IOError, OSError, ValueError, AttributeError):
+            pass
+        return manifest
+
+    @staticmethod
+    def hash_text(text):
+        """Hash of a file's text as HandeeFramer writes it."""
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _key(self, path):
+        return posixpath.normpath(os.path.relpath(path, self.root_path).replace(os.sep, '/'))
+
+    def unmodified_hash(self, path):
+        """Return the text hash of path if it is our unmodified output, else None."""
+        entry = self.entries.get(self._key(path))
+        if entry is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != entry.get('size') or st.st_mtime_ns != entry.get('mtime_ns'):
+            return None
+        return entry.get('sha1')
+
+    def record(self, path, text=None):
+        """Record a file that was just written; `text` is all of it, or None to read it back."""
+        if text is None:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        st = os.stat(path)
+        self.entries[self._key(path)] = {
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha1': self.hash_text(text),
+        }
+        self.changed = True
+
+    def save(self):
+        """Write the manifest if anything was recorded, replacing the old one."""
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'files': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+        self.changed = False
+
+
+class ArchiveOutput:
+    """Build target that writes directories and files into a zip or tar archive.
+
+    Member names are paths relative to base_path. The archive is written to a
+    temporary file next to `path` and moved into place when closed, so a
+    failed build leaves no partial archive behind. Nested `with` blocks share
+    the archive; it is closed when the outermost one exits.
+    """
+
+    TAR_MODES = (
+        ('.tar.gz', 'w:gz'), ('.tgz', 'w:gz'),
+        ('.tar.bz2', 'w:bz2'), ('.tbz2', 'w:bz2'),
+        ('.tar.xz', 'w:xz'), ('.txz', 'w:xz'),
+        ('.tar', 'w'),
+    )
+
+    def __init__(self, path, base_path):
+        self.path = path
+        self.base_path = base_path
+        lower = path.lower()
+        self.tar_mode = next((mode for suffix, mode in self.TAR_MODES if lower.endswith(suffix)), None)
+        if self.tar_mode is None and not lower.endswith('.zip'):
+            raise BuildError("Unsupported archive type: {0}\n\nUse .zip, .tar, .tar.gz, .tar.bz2 "
+                             "or .tar.xz".format(os.path.basename(path)))
+        self._archive = None
+        self._temp_path = None
+        self._depth = 0
+        self._mtime = time.time()
+
+    @staticmethod
+    def supported(path):
+        """Whether path names an archive type ArchiveOutput can write."""
+        lower = path.lower()
+        return lower.endswith('.zip') or any(lower.endswith(suffix) for suffix, _ in ArchiveOutput.TAR_MODES)
+
+    def __enter__(self):
+        self._depth += 1
+        if self._depth > 1:
+            return self
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # Created like any new file (not with mkstemp's 0600), so it gets the umask's usual mode
+        self._temp_path = os.path.join(directory, '.handeeframer-{0}.tmp'.format(uuid.uuid4().hex))
+        open(self._temp_path, 'xb').close()
+        if self.tar_mode:
+            self._archive = tarfile.open(self._temp_path, self.tar_mode)
+        else:
+            self._archive = zipfile.ZipFile(self._temp_path, 'w', zipfile.ZIP_DEFLATED)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth:
+            return False
+        self._archive.close()
+        if exc_type is None:
+            os.replace(self._temp_path, self.path)
+        else:
+            os.remove(self._temp_path)
+        return False
+
+    def _member_name(self, path):
+        relpath = os.path.relpath(path, self.base_path)
+        if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+            raise BuildError("Path is outside the archive root: {0}".format(path))
+        return relpath.replace(os.sep, '/')
+
+    def add_dir(self, path):
+        """Add a directory entry."""
+        name = self._member_name(path)
+        if self.tar_mode:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = self._mtime
+            self._archive.addfile(info)
+        else:
+            info = zipfile.ZipInfo(name + '/', time.localtime(self._mtime)[:6])
+            info.external_attr = (0o40755 << 16) | 0x10
+            self._archive.writestr(info, b'')
+
+    def add_file(self, path, content):
+        """Add a file holding `content` (text)."""
+        name = self._member_name(path)
+        data = content.encode('utf-8')
+        if self.tar_mode:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = self._mtime
+            self._archive.addfile(info, io.BytesIO(data))
+        else:
+            info = zipfile.ZipInfo(name, time.localtime(self._mtime)[:6])
+            info.external_attr = 0o100644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self._archive.writestr(info, data)
+
+
+class BuildOperation:
+    """A single step of a BuildPlan."""
+
+    MKDIR = 'mkdir'
+    CREATE = 'create'
+    APPEND = 'append'
+    DUPLICATE = 'duplicate'
+    UPDATE = 'update'
+    SKIP = 'skip'
+
+    KINDS = (MKDIR, CREATE, APPEND, DUPLICATE, UPDATE, SKIP)
+
+    __slots__ = ('kind', 'path', 'content', 'note')
+
+    def __init__(self, kind, path, content=None, note=None):
+        self.kind = kind
+        self.path = path
+        self.content = content  # Text written by create/append/duplicate/update
+        self.note = note  # Why this step was chosen, for logs and previews
+
+    def __repr__(self):
+        return "BuildOperation({0}, {1})".format(self.kind, self.path)
+
+
+class BuildPlan:
+    """Ordered list of operations that builds a tree, produced by TreeBuilder.plan()."""
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def add(self, kind, path, content=None, note=None):
+        """Append an operation and return it."""
+        operation = BuildOperation(kind, path, content, note)
+        self.operations.append(operation)
+        return operation
+
+    def counts(self):
+        """Return a dict of operation kind -> number of operations."""
+        counts = {}
+        for operation in self.operations:
+            counts[operation.kind] = counts.get(operation.kind, 0) + 1
+        return counts
+
+    def describe(self):
+        """Return a human-readable listing of the plan, one operation per line."""
+        lines = ["Root: {0}".format(self.root_path), ""]
+        for operation in self.operations:
+            line = "{0:<10} {1}".format(operation.kind, os.path.relpath(operation.path, self.root_path))
+            if operation.note:
+                line += "  ({0})".format(operation.note)
+            lines.append(line)
+        return "\n".join(lines)
+
 
 class TreeBuilder:
-    """Builds the actual file/folder structure from TreeNode objects."""
+    """Builds the actual file/folder structure from TreeNode objects.
+
+    Building happens in two phases: plan() decides what to do for every node
+    and fence without writing anything, and execute() carries the plan out.
+
+    With `sync` on (which needs a manifest), a file the previous build wrote
+    and nobody edited since is rewritten when its fence content changed,
+    instead of getting a 'name (N).ext' duplicate.
+
+    With `staged` on, the files are first written into a temporary sibling of
+    the root and only moved into place once all of them were written, so a
+    failed or cancelled build leaves the target untouched. Only the root is
+    staged: a code fence naming a path outside it is skipped with a warning.
+
+    With an `output` (an ArchiveOutput) the plan is written into an archive
+    instead of the file system; plan against DirectorySnapshot.offline_at()
+    so the tree is planned as if nothing existed yet.
+
+    Builders of one job can share a `pool` (a ThreadPoolExecutor) for their
+    file writes; without one, each execute() starts its own.
 
-    def __init__(self, root_path, logger=None):
+    `locate` turns the line number of a code fence into a description of
+    where it is (see BuildJob.locate), for messages about that fence.
+    """
+
+    def __init__(self, root_path, logger=None, progress=None, dry_run=False, snapshot=None,
+                 max_workers=DEFAULT_MAX_WORKERS, trace=None, manifest=None, sync=False,
+                 staged=False, output=None, pool=None, locate=None):
         self.root_path = root_path
         self.logger = logger or BuildLogger(root_path)
+        self.progress = progress or BuildProgress()
+        self.trace = trace or BuildTrace()
+        self.dry_run = dry_run
+        self.snapshot = snapshot or DirectorySnapshot()
+        self.max_workers = max_workers
+        self.manifest = manifest  # BuildManifest of this root, or None to go without
+        self.sync = sync and manifest is not None
+        self.staged = staged
+        self.output = output
+        self.pool = pool
+        self.locate = locate or "line {0}".format
         self.created_dirs = set()
         self.created_files = set()
+        self.updated_files = set()
         self.skipped = set()
         self.node_map = {}  # Map full paths to nodes for content filling
+        self.basename_index = {}  # basename -> [full paths], in tree order
+        self.relpath_index = {}  # normalized 'a/b/c' relative path -> full path
+        self.ambiguous_matches = []  # (filename, chosen path, all candidates)
+        self.fence_count = 0  # Code fences planned so far
+        self.operation_counts = dict.fromkeys(BuildOperation.KINDS, 0)  # Operations planned so far, by kind
+
+        # Planning state; the snapshot tracks which paths the plan creates
+        self._planned_files = {}  # path -> CREATE operation for files this plan creates
+        self._filled = set()  # files that already receive content in this plan
+        self._written = {}  # streamed builds: path -> text of a file this build created
 
     def build(self, nodes, code_fences=None):
         """Build the file structure from the tree nodes.
 
         Args:
             nodes: List of root TreeNode objects
-            code_fences: Optional list of (filename, content, line_num) tuples
+            code_fences: Optional list of (filename, content, line_num) tuples,
+                or an iterator of them such as CodeFenceDetector.iter_code_fences()
+
+        With dry_run set, nothing is written and the stats carry the plan.
+
+        An iterator of fences is consumed as it goes when building straight
+        to disk: the tree is written first, then each fence is planned and
+        written as it arrives, so fence contents never pile up in the plan.
+        Other builds read it into a list first.
         """
         try:
-            self.logger.section("Building File Structure")
-            self.logger.info("Processing {0} root node(s)".format(len(nodes)))
-
-            # First pass: create all files and directories
-            for node in nodes:
-                self._build_node(node, self.root_path)
-
-            self.logger.info("Created {0} directories".format(len(self.created_dirs)))
-            self.logger.info("Created {0} files".format(len(self.created_files)))
-            self.logger.info("Skipped {0} existing items".format(len(self.skipped)))
-
-            # Second pass: fill in content from code fences
-            if code_fences:
-                self.logger.section("Filling Content from Code Fences")
-                self._fill_content_from_fences(nodes, code_fences)
-
-            return {
-                'dirs': len(self.created_dirs),
-                'files': len(self.created_files),
-                'skipped': len(self.skipped)
-            }
+            if code_fences is not None and not isinstance(code_fences, (list, tuple)):
+                if not (self.dry_run or self.staged or self.output is not None):
+                    return self._build_streaming(nodes, code_fences)
+                code_fences = list(code_fences)
+
+            with self.trace.phase('plan'):
+                plan = self.plan(nodes, code_fences)
+
+            counts = plan.counts()
+            self._count_operations(plan)
+
+            if self.dry_run:
+                self.logger.info("Dry run: {0} operation(s) planned, nothing written", len(plan))
+                return {
+                    'dirs': counts.get(BuildOperation.MKDIR, 0),
+                    'files': counts.get(BuildOperation.CREATE, 0) + counts.get(BuildOperation.DUPLICATE, 0),
+                    'updated': counts.get(BuildOperation.UPDATE, 0),
+                    'skipped': counts.get(BuildOperation.SKIP, 0),
+                    'ambiguous': len(self.ambiguous_matches),
+                    'plan': plan
+                }
+
+            with self.trace.phase('execute'):
+                try:
+                    if self.output is not None:
+                        self.execute_archive(plan)
+                    elif self.staged:
+                        self.execute_staged(plan)
+                    else:
+                        self.execute(plan)
+                finally:
+                    self._save_manifest()
+
+            return self._stats()
+        except BuildCancelled:
+            self.logger.warning("Build cancelled", context=("Root path: {0}", self.root_path))
+            raise
         except Exception as e:
             self.logger.error("Build failed", e, "Root path: {0}".format(self.root_path))
             raise
 
-    def _ensure_dir(self, path):
-        """Ensure directory exists; track any directories created along the way."""
+    def _stats(self):
+        """Stats of a build that has run."""
+        return {
+            'dirs': len(self.created_dirs),
+            'files': len(self.created_files),
+            'updated': len(self.updated_files),
+            'skipped': len(self.skipped),
+            'ambiguous': len(self.ambiguous_matches)
+        }
+
+    def _build_streaming(self, nodes, code_fences):
+        """Write the tree, then plan and write each code fence as it arrives."""
+        with self.trace.phase('plan'):
+            plan = self.plan(nodes)
+        self._count_operations(plan)
+
+        with self.trace.phase('execute'):
+            try:
+                self.execute(plan)
+                self._stream_fences(code_fences)
+            finally:
+                self._save_manifest()
+                self.trace.update(fences=self.fence_count)
+
+        return self._stats()
+
+    def _count_operations(self, plan):
+        """Add the operations of `plan` to operation_counts and the trace."""
+        for kind, count in plan.counts().items():
+            self.operation_counts[kind] += count
+        self.trace.update(operations=dict(self.operation_counts))
+
+    def _stream_fences(self, code_fences):
+        """Plan and write code fences one at a time, with a bounded number of writes in flight."""
+        self.logger.section("Writing Content from Code Fences")
+
+        # The tree's files are on disk now. Fences fill them like existing
+        # files, starting from the text written to them instead of reading it back
+        self._written = dict((path, operation.content) for path, operation in self._planned_files.items()
+                             if path in self.created_files)
+        self._planned_files = {}
+        self._index_paths()
+
+        window = max(1, self.max_workers) * 4
+        pending = deque()
+        with self._write_pool() as pool:
+            try:
+                for fence in code_fences:
+                    self.progress.update("Writing code fences: {0}", self.fence_count + 1)
+                    plan = BuildPlan(self.root_path)
+                    self._plan_fence(plan, fence)
+                    self._count_operations(plan)
+                    for operation in plan:
+                        if operation.kind in (BuildOperation.MKDIR, BuildOperation.SKIP):
+                            self._execute_operation(operation)
+                        else:
+                            pending.append((operation, pool.submit(self._write_file, operation)))
+
+                    while len(pending) > window:
+                        operation, future = pending.popleft()
+                        self._record_write(operation, future.result)
+
+                while pending:
+                    operation, future = pending.popleft()
+                    self._record_write(operation, future.result)
+            except BuildCancelled:
+                for _, future in pending:
+                    future.cancel()
+                raise
+
+        self.logger.info("Wrote {0} code fences", self.fence_count)
+
+    def plan(self, nodes, code_fences=None):
+        """Turn tree nodes and code fences into a BuildPlan without touching disk."""
+        plan = BuildPlan(self.root_path)
+
+        self.logger.section("Planning File Structure")
+        self.logger.info("Processing {0} root node(s)", len(nodes))
+
+        # First pass: directories and files from the tree
+        for node in nodes:
+            self._plan_node(plan, node, self.root_path)
+
+        # Second pass: content from code fences
+        if code_fences:
+            self.logger.section("Planning Content from Code Fences")
+            self._index_paths()
+            self._plan_fences(plan, code_fences)
+
+        self.logger.info("Planned {0} operation(s)", len(plan),
+                         context=", ".join("{0}: {1}".format(k, v) for k, v in sorted(plan.counts().items())))
+        self.logger.info("Directory listings read: {0}", self.snapshot.reads)
+        return plan
+
+    def execute(self, plan):
+        """Carry out a BuildPlan, recording what was created and skipped.
+
+        Directories are created top-down on this thread; file bodies are then
+        written concurrently by up to max_workers threads. Results are logged
+        in plan order, so the log reads the same however the writes interleave.
+        """
+        self.logger.section("Building File Structure")
+
+        failed_dirs = set()
+        file_operations = []
+        total = len(plan)
+
+        for index, operation in enumerate(plan):
+            path = operation.path
+
+            if os.path.dirname(path) in failed_dirs:
+                if operation.kind == BuildOperation.MKDIR:
+                    failed_dirs.add(path)
+                self.logger.error("Parent directory was not created: {0}".format(path))
+                continue
+
+            if operation.kind not in (BuildOperation.MKDIR, BuildOperation.SKIP):
+                file_operations.append(operation)
+                continue
+
+            self.progress.update("Building: {0}/{1}", index + 1, total)
+            try:
+                self._execute_operation(operation)
+            except Exception as e:
+                if operation.kind == BuildOperation.MKDIR:
+                    failed_dirs.add(path)
+                self.logger.error("Failed to {0}: {1}".format(operation.kind, path), e)
+
+        self._write_files(file_operations)
+
+        self.logger.info("Created {0} directories", len(self.created_dirs))
+        self.logger.info("Created {0} files", len(self.created_files))
+        if self.updated_files:
+            self.logger.info("Updated {0} files", len(self.updated_files))
+        self.logger.info("Skipped {0} existing items", len(self.skipped))
+
+    def execute_archive(self, plan):
+        """Write a BuildPlan into self.output, one member after another."""
+        self.logger.section("Writing Archive")
+        total = len(plan)
+
+        with self.output as output:
+            for index, operation in enumerate(plan):
+                self.progress.update("Archiving: {0}/{1}", index + 1, total)
+                kind = operation.kind
+                path = operation.path
+                if kind == BuildOperation.MKDIR:
+                    output.add_dir(path)
+                    self.created_dirs.add(path)
+                elif kind in (BuildOperation.CREATE, BuildOperation.DUPLICATE):
+                    output.add_file(path, operation.content)
+                    self.created_files.add(path)
+                elif kind == BuildOperation.SKIP:
+                    self._execute_operation(operation)
+                else:
+                    raise BuildError("Can't {0} inside an archive: {1}".format(kind, path))
+
+        self.logger.info("Archive written: {0}", self.output.path)
+        self.logger.info("Archived {0} directories and {1} files",
+                         len(self.created_dirs), len(self.created_files))
+
+    def execute_staged(self, plan):
+        """Carry out a BuildPlan through a staging directory next to the root.
+
+        Every file is first written into the staging directory (appends start
+        from a copy of the original). Only when all writes succeeded is the
+        result committed: with one os.rename if the root doesn't exist yet,
+        otherwise by moving each file into place with os.replace. Raises
+        BuildError, with the target untouched, if any staged write fails.
+        """
+        self.logger.section("Building File Structure (staged)")
+        root_path = os.path.normpath(self.root_path)
+        parent = os.path.dirname(root_path)
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.{0}.staging-'.format(os.path.basename(root_path)),
+                                   dir=parent)
+        self.logger.info("Staging in: {0}", staging)
+
+        try:
+            staged = self._stage(plan, root_path, staging)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        self.progress.update("Committing", force=True)
+        if not os.path.exists(root_path):
+            os.rename(os.path.join(staging, 'root'), root_path)
+            shutil.rmtree(staging, ignore_errors=True)
+            self.logger.info("Committed new root with a single rename: {0}", root_path)
+            moved = None
+        else:
+            moved = os.path.join(staging, 'root')
+
+        try:
+            for operation, staged_path in staged:
+                self._commit_operation(operation, staged_path if moved else None)
+        finally:
+            if moved:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        self.logger.info("Created {0} directories", len(self.created_dirs))
+        self.logger.info("Created {0} files", len(self.created_files))
+        if self.updated_files:
+            self.logger.info("Updated {0} files", len(self.updated_files))
+        self.logger.info("Skipped {0} existing items", len(self.skipped))
+
+    def _stage(self, plan, root_path, staging):
+        """Write every planned file into staging/root; return [(operation, staged path)]."""
+        staged_root = os.path.join(staging, 'root')
+        os.mkdir(staged_root)
+        staged = []
+        writes = []
+        staged_dirs = {staged_root}
+
+        for operation in plan:
+            if operation.kind == BuildOperation.SKIP:
+                staged.append((operation, None))
+                continue
+
+            if not self._inside_root(operation.path):
+                if operation.kind == BuildOperation.MKDIR:
+                    # A missing parent of the root, created along with the staging directory
+                    staged.append((operation, None))
+                    continue
+                raise BuildError("Staged builds can't write outside the root: {0}".format(operation.path))
+            staged_path = os.path.normpath(os.path.join(staged_root, os.path.relpath(operation.path, root_path)))
+            staged.append((operation, staged_path))
+
+            if operation.kind == BuildOperation.MKDIR:
+                os.makedirs(staged_path, exist_ok=True)
+                staged_dirs.add(staged_path)
+                continue
+
+            directory = os.path.dirname(staged_path)
+            if directory not in staged_dirs:
+                os.makedirs(directory, exist_ok=True)
+                staged_dirs.add(directory)
+
+            kind = operation.kind
+            if kind in (BuildOperation.APPEND, BuildOperation.UPDATE):
+                # Start from the original so appends keep its text and both keep its mode
+                shutil.copy2(operation.path, staged_path)
+            elif kind == BuildOperation.DUPLICATE:
+                kind = BuildOperation.CREATE
+            writes.append(BuildOperation(kind, staged_path, operation.content))
+
+        # Nothing else writes into the staging directory, so no probes are needed
+        total = len(writes)
+        failures = []
+        with self._write_pool() as pool:
+            futures = [pool.submit(self._write_file, write) for write in writes]
+            try:
+                for index, (write, future) in enumerate(zip(writes, futures)):
+                    self.progress.update("Staging files: {0}/{1}", index + 1, total)
+                    try:
+                        if future.result() == 'exists':
+                            # The plan put two things at one path; don't let either win silently
+                            raise FileExistsError("Already staged: {0}".format(write.path))
+                    except Exception as e:
+                        self.logger.error("Failed to stage: {0}".format(write.path), e)
+                        failures.append(write.path)
+            except BuildCancelled:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        if failures:
+            raise BuildError("{0} file(s) could not be written; nothing was changed in {1}".format(
+                len(failures), root_path))
+        return staged
+
+    def _commit_operation(self, operation, staged_path):
+        """Account for one staged operation; move its file into place when staged_path is set."""
+        kind = operation.kind
+        path = operation.path
+
+        if kind == BuildOperation.SKIP:
+            self._execute_operation(operation)
+            return
+
+        if kind == BuildOperation.MKDIR:
+            if staged_path:
+                os.makedirs(path, exist_ok=True)
+            self.created_dirs.add(path)
+            self.logger.debug("Created directory: {0}", path)
+            return
+
+        def commit():
+            if staged_path:
+                if kind in (BuildOperation.CREATE, BuildOperation.DUPLICATE) and os.path.lexists(path):
+                    return 'exists'
+                os.replace(staged_path, path)
+            return {BuildOperation.APPEND: 'appended', BuildOperation.UPDATE: 'updated'}.get(kind, 'created')
+
+        self._record_write(operation, commit)
+
+    def _save_manifest(self):
+        """Store the manifest, if there is one; a failure here doesn't fail the build."""
+        if self.manifest is None:
+            return
+        try:
+            self.manifest.save()
+        except (IOError, OSError) as e:
+            self.logger.error("Failed to write manifest: {0}".format(self.manifest.path), e)
+
+    def _execute_operation(self, operation):
+        """Perform one planned directory or skip operation."""
+        path = operation.path
+
+        if operation.kind == BuildOperation.MKDIR:
+            os.makedirs(path, exist_ok=True)
+            self.created_dirs.add(path)
+            self.logger.debug("Created directory: {0}", path)
+        else:
+            self.skipped.add(path)
+            self.logger.debug("Skipped: {0}", path, context=operation.note)
+
+    def _write_files(self, operations):
+        """Write planned files, through a thread pool when it is worth it."""
+        total = len(operations)
+
+        if self.max_workers <= 1 or total <= 1:
+            for index, operation in enumerate(operations):
+                self.progress.update("Writing files: {0}/{1}", index + 1, total)
+                self._record_write(operation, lambda: self._write_file(operation))
+            return
+
+        with self._write_pool() as pool:
+            futures = [pool.submit(self._write_file, operation) for operation in operations]
+            try:
+                for index, (operation, future) in enumerate(zip(operations, futures)):
+                    self.progress.update("Writing files: {0}/{1}", index + 1, total)
+                    self._record_write(operation, future.result)
+            except BuildCancelled:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    @contextmanager
+    def _write_pool(self):
+        """The shared pool if there is one, otherwise a pool for this batch of writes."""
+        if self.pool is not None:
+            yield self.pool
+            return
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as pool:
+            yield pool
+
+    @staticmethod
+    def _write_file(operation):
+        """Write one planned file. Runs on a worker thread, so it only touches disk.
+
+        Returns 'appended', 'updated', 'created', or 'exists' if a new file's
+        path was taken.
+        """
+        if operation.kind == BuildOperation.APPEND:
+            with open(operation.path, 'a', encoding='utf-8') as f:
+                f.write(operation.content)
+            return 'appended'
+
+        if operation.kind == BuildOperation.UPDATE:
+            # Only planned for our own unmodified output, so replacing it is safe
+            with open(operation.path, 'w', encoding='utf-8') as f:
+                f.write(operation.content)
+            return 'updated'
+
+        # CREATE and DUPLICATE both write a new file. Exclusive mode keeps
+        # this non-destructive even if the file appeared after planning.
+        try:
+            f = open(operation.path, 'x', encoding='utf-8')
+        except FileExistsError:
+            return 'exists'
+        with f:
+            f.write(operation.content)
+        return 'created'
+
+    def _record_write(self, operation, result):
+        """Log and account for one file write; result() returns its outcome or raises."""
+        path = operation.path
+        try:
+            outcome = result()
+        except Exception as e:
+            self.logger.error("Failed to {0}: {1}".format(operation.kind, path), e)
+            return
+
+        if self.manifest is not None and outcome != 'exists':
+            text = operation.content
+            if outcome == 'appended':
+                # An append may leave text we didn't write in the file; then read it back
+                written = self._written.get(path)
+                text = None if written is None else written + operation.content
+            try:
+                self.manifest.record(path, text)
+            except (IOError, OSError, ValueError) as e:
+                self.logger.warning("Could not record in manifest: {0}", path, context=str(e))
+
+        if outcome == 'appended':
+            self.logger.debug("Appended content to: {0}", path)
+        elif outcome == 'updated':
+            self.updated_files.add(path)
+            self.logger.debug("Updated file: {0}", path, context=operation.note)
+        elif outcome == 'exists':
+            self.skipped.add(path)
+            self.logger.warning("File appeared since planning, skipped: {0}", path)
+        elif operation.kind == BuildOperation.DUPLICATE:
+            self.created_files.add(path)
+            self.logger.warning("File had content, created duplicate: {0}", path)
+        else:
+            self.created_files.add(path)
+            self.logger.debug("Created file: {0}", path, context=operation.note)
+
+    def _exists(self, path):
+        """Whether path exists on disk or will exist once the plan has run."""
+        return self.snapshot.exists(path)
+
+    def _is_dir(self, path):
+        """Whether path is, or will be, a directory."""
+        return self.snapshot.is_dir(path)
+
+    def _plan_dirs(self, plan, path):
+        """Plan creation of path and any missing parents, topmost first.
+
+        Raises BuildError if path or a parent is, or will be, a file.
+        """
         path = os.path.normpath(path)
 
         # Build list of missing dirs from top to bottom
         missing = []
         cur = path
-        while cur and not os.path.exists(cur):
+        while cur and not self._exists(cur):
             missing.append(cur)
             parent = os.path.dirname(cur)
             if parent == cur:
                 break
             cur = parent
+        if cur and self._exists(cur) and not self._is_dir(cur):
+            raise BuildError("Not a directory: {0}".format(cur))
 
-        # Create from topmost missing to leaf
         for d in reversed(missing):
-            os.makedirs(d, exist_ok=True)
-            self.created_dirs.add(d)
-            self.logger.info("Created directory (implicit): {0}".format(d))
+            plan.add(BuildOperation.MKDIR, d)
+            self.snapshot.add_dir(d)
+
+    def _plan_file(self, plan, path, content, note=None):
+        """Plan creation of a new file, including its parent directories."""
+        self._plan_dirs(plan, os.path.dirname(path))
+        self._planned_files[path] = plan.add(BuildOperation.CREATE, path, content, note)
+        self.snapshot.add_file(path)
 
     def _format_comment(self, file_path, comment):
         """Format a single-line comment appropriate for the file type."""
@@ -831,63 +2465,36 @@ class TreeBuilder:
         # Fallback
         return "# {0}".format(c)
 
-    def _build_node(self, node, parent_path):
-        """Recursively build a node and its children."""
-        try:
-            full_path = os.path.join(parent_path, node.name)
+    def _plan_node(self, plan, node, parent_path):
+        """Recursively plan a node and its children."""
+        self.progress.update("Planning: {0} operations", len(plan))
+        full_path = os.path.join(parent_path, node.name)
 
-            # Store node mapping for later content filling
-            self.node_map[full_path] = node
+        # Store node mapping for later content filling
+        self.node_map[full_path] = node
 
-            if node.is_leaf:
-                # Create file
-                if os.path.exists(full_path):
-                    self.skipped.add(full_path)
-                    self.logger.info("Skipped existing file: {0}".format(full_path))
-                else:
-                    try:
-                        # Ensure parent directory exists and count any newly created dirs
-                        self._ensure_dir(os.path.dirname(full_path))
-
-                        # Create file with comment if it exists
-                        with open(full_path, 'w', encoding='utf-8') as f:
-                            if node.comment:
-                                comment_line = self._format_comment(full_path, node.comment)
-                                f.write(comment_line + '\n')
-
-                        self.created_files.add(full_path)
-                        self.logger.info(
-                            "Created file: {0}".format(full_path),
-                            "With comment: {0}".format(node.comment) if node.comment else None
-                        )
-                    except Exception as e:
-                        self.logger.error("Failed to create file: {0}".format(full_path), e)
-            else:
-                # Create directory
-                if os.path.exists(full_path) and not os.path.isdir(full_path):
-                    self.skipped.add(full_path)
-                    self.logger.warning("Path exists but is not a directory: {0}".format(full_path))
-                    return
+        if node.is_leaf:
+            if self._exists(full_path):
+                plan.add(BuildOperation.SKIP, full_path, note="existing file")
+                return
 
-                try:
-                    # Ensure directory exists and count any newly created dirs
-                    self._ensure_dir(full_path)
-                    self.logger.info("Ensured directory: {0}".format(full_path))
-                except Exception as e:
-                    self.logger.error("Failed to create directory: {0}".format(full_path), e)
-                    return
+            # Create file with comment if it exists
+            content = ""
+            if node.comment:
+                content = self._format_comment(full_path, node.comment) + '\n'
+            self._plan_file(plan, full_path, content,
+                            "With comment: {0}".format(node.comment) if node.comment else None)
+        else:
+            if self._exists(full_path) and not self._is_dir(full_path):
+                plan.add(BuildOperation.SKIP, full_path, note="path exists but is not a directory")
+                self.logger.warning("Path exists but is not a directory: {0}", full_path)
+                return
 
-                # Build children
-                for child in node.children:
-                    self._build_node(child, full_path)
+            self._plan_dirs(plan, full_path)
 
-        except Exception as e:
-            self.logger.error(
-                "Error building node: {0}".format(node.name),
-                e,
-                "Parent: {0}".format(parent_path)
-            )
-            raise
+            # Plan children
+            for child in node.children:
+                self._plan_node(plan, child, full_path)
 
         # def _format_comment(self, filepath, comment):
         #     """Format comment with appropriate syntax based on file extension."""
@@ -914,96 +2521,198 @@ class TreeBuilder:
         #     else:
         #         return "# {0}".format(comment)
 
-    def _fill_content_from_fences(self, nodes, code_fences):
-        """Fill file content from code fences."""
-        self.logger.info("Processing {0} code fences".format(len(code_fences)))
+    def _plan_fences(self, plan, code_fences):
+        """Plan how each code fence's content reaches its file."""
+        self.logger.info("Processing {0} code fences", len(code_fences))
 
-        for filename, content, line_num in code_fences:
-            try:
-                self.logger.info("Processing fence: {0}".format(filename), "From line {0}, {1} chars".format(line_num, len(content)))
-
-                # Try to find the file in our node map
-                matched_path = self._find_matching_file(filename, nodes)
-
-                if matched_path:
-                    self.logger.info("Matched to tree path: {0}".format(matched_path))
-                    node = self.node_map.get(matched_path)
-
-                    # Check if file exists and what's in it
-                    if os.path.exists(matched_path):
-                        with open(matched_path, 'r', encoding='utf-8') as f:
-                            existing_content = f.read()
-
-                        # Check if it's only our comment
-                        is_only_comment = False
-                        if node and node.comment:
-                            comment_line = self._format_comment(matched_path, node.comment)
-                            if existing_content.strip() == comment_line.strip():
-                                is_only_comment = True
-
-                        # Determine action
-                        if not existing_content.strip() or is_only_comment:
-                            # Empty or only has our comment - safe to append
-                            with open(matched_path, 'a', encoding='utf-8') as f:
-                                if existing_content and not existing_content.endswith('\n'):
-                                    f.write('\n')
-                                f.write(content)
-                            self.logger.info("Appended content to: {0}".format(matched_path))
-                        else:
-                            # File has other content - create duplicate
-                            new_path = self._get_duplicate_filename(matched_path)
-                            with open(new_path, 'w', encoding='utf-8') as f:
-                                f.write(content)
-                            self.created_files.add(new_path)
-                            self.logger.warning("File had content, created duplicate: {0}".format(new_path))
-                    else:
-                        # File doesn't exist yet - create it
-                        os.makedirs(os.path.dirname(matched_path), exist_ok=True)
-                        with open(matched_path, 'w', encoding='utf-8') as f:
-                            if node and node.comment:
-                                comment_line = self._format_comment(matched_path, node.comment)
-                                f.write(comment_line + '\n')
-                            f.write(content)
-                        self.created_files.add(matched_path)
-                        self.logger.info("Created new file with content: {0}".format(matched_path))
-                else:
-                    # Path not in tree - create it as shorthand
-                    self.logger.info("Not in tree, creating as shorthand: {0}".format(filename))
-                    self._create_from_shorthand(filename, content)
+        for index, fence in enumerate(code_fences):
+            self.progress.update("Planning code fences: {0}/{1}", index + 1, len(code_fences))
+            self._plan_fence(plan, fence)
 
-            except Exception as e:
-                self.logger.error("Failed to process fence: {0}".format(filename), e, 
-                                "Line {0}, content length: {1}".format(line_num, len(content)))
-                # Continue with other fences
+    def _plan_fence(self, plan, fence):
+        """Plan how one code fence's content reaches its file."""
+        filename, content, line_num = fence
+        self.fence_count += 1
+        try:
+            self.logger.debug("Processing fence: {0}", filename, context=("From line {0}, {1} chars", line_num, len(content)))
+
+            # Try to find the file in our node map
+            matched_path = self._find_matching_file(filename, line_num)
+
+            if matched_path:
+                self.logger.debug("Matched to tree path: {0}", matched_path)
+                node = self.node_map.get(matched_path)
+                if node is not None and not node.is_leaf:
+                    plan.add(BuildOperation.SKIP, matched_path, note="code fence matches a directory")
+                    self.logger.warning("Code fence matches a directory: {0}", matched_path)
+                    return
+            else:
+                # Path not in tree - create it as shorthand
+                self.logger.debug("Not in tree, creating as shorthand: {0}", filename)
+                matched_path = os.path.normpath(os.path.join(self.root_path, filename.replace('\\', '/')))
+                node = None
+                if self.staged and not self._inside_root(matched_path):
+                    plan.add(BuildOperation.SKIP, matched_path, note="outside the root of a staged build")
+                    self.logger.warning("Code fence path is outside the root of a staged build: {0}", filename,
+                                        context=self.locate(line_num))
+                    return
+
+            self._plan_fill(plan, matched_path, node, content)
+
+        except Exception as e:
+            self.logger.error("Failed to process fence: {0}".format(filename), e,
+                              "At {0}, content length: {1}".format(self.locate(line_num), len(content)))
+
+    def _inside_root(self, path):
+        """Whether path is the root or below it."""
+        relpath = os.path.relpath(path, self.root_path)
+        return not (relpath == os.pardir or relpath.startswith(os.pardir + os.sep))
+
+    def _plan_fill(self, plan, path, node, content):
+        """Plan writing fence content to path: create, append or duplicate."""
+        comment_line = ""
+        if node and node.comment:
+            comment_line = self._format_comment(path, node.comment) + '\n'
+
+        if not self._exists(path):
+            # File doesn't exist yet - create it with comment and content
+            self._plan_file(plan, path, comment_line + content, "with code fence content")
+            self._filled.add(path)
+            return
+
+        if path in self._filled:
+            # Already receives content in this plan
+            existing_content = None
+        elif path in self._planned_files:
+            # Created by this plan with at most its comment: write the content
+            # along with it, so the new file is opened and written once
+            operation = self._planned_files[path]
+            operation.content += content
+            operation.note = "{0}, with code fence content".format(operation.note) if operation.note \
+                else "with code fence content"
+            self._filled.add(path)
+            return
+        elif path in self._written:
+            # Created by this build before its fences were streamed in
+            existing_content = self._written[path]
+        else:
+            # Existed before the build: check what it holds
+            known_hash = self.manifest.unmodified_hash(path) if self.manifest else None
+            if known_hash is None:
+                with open(path, 'r', encoding='utf-8') as f:
+                    existing_content = f.read()
+            elif known_hash == BuildManifest.hash_text(comment_line + content):
+                plan.add(BuildOperation.SKIP, path, note="unchanged since last build")
+                self._filled.add(path)
+                return
+            elif known_hash == BuildManifest.hash_text(comment_line):
+                # Our own output holding just its comment (or nothing)
+                existing_content = comment_line
+            elif self.sync:
+                plan.add(BuildOperation.UPDATE, path, comment_line + content, "fence content changed")
+                self._filled.add(path)
+                return
+            else:
+                # Our own output, with content other than this fence's
+                existing_content = None
+
+        # Check if it's only our comment
+        is_only_comment = False
+        if existing_content and node and node.comment:
+            comment_line = self._format_comment(path, node.comment)
+            if existing_content.strip() == comment_line.strip():
+                is_only_comment = True
+
+        if existing_content is not None and (not existing_content.strip() or is_only_comment):
+            # Empty or only has our comment - safe to append
+            if existing_content and not existing_content.endswith('\n'):
+                content = '\n' + content
+            plan.add(BuildOperation.APPEND, path, content)
+            self._filled.add(path)
+        else:
+            # File has other content - create duplicate, unless an earlier
+            # build already made one holding this same content
+            own_copy, unchanged = self._find_own_copy(path, content)
+            if own_copy and unchanged:
+                plan.add(BuildOperation.SKIP, own_copy, note="unchanged since last build")
+                self._filled.add(own_copy)
+                return
+            if own_copy:
+                plan.add(BuildOperation.UPDATE, own_copy, content, "fence content changed")
+                self._filled.add(own_copy)
+                return
 
-    def _find_matching_file(self, filename, nodes):
-        """Find a file in the tree that matches the filename/path."""
+            new_path = self._get_duplicate_filename(path)
+            plan.add(BuildOperation.DUPLICATE, new_path, content, "duplicate of {0}".format(os.path.basename(path)))
+            self.snapshot.add_file(new_path)
+            self._filled.add(new_path)
+
+    @staticmethod
+    def _normalize_relpath(path):
+        """Normalize a relative path to 'a/b/c' form for index lookups."""
+        return posixpath.normpath(path.replace('\\', '/'))
+
+    def _index_paths(self):
+        """Index node_map by basename and by relative path (once, after the first pass)."""
+        self.basename_index = {}
+        self.relpath_index = {}
+
+        for path in self.node_map:
+            self.basename_index.setdefault(os.path.basename(path), []).append(path)
+            relpath = self._normalize_relpath(os.path.relpath(path, self.root_path))
+            self.relpath_index.setdefault(relpath, path)
+
+    def _find_matching_file(self, filename, line_num=None):
+        """Find a file in the tree that matches the filename/path of the fence at line_num."""
         # Check if it's a full path or just a filename
         if '/' in filename or '\\' in filename:
-            # It's a path - try to match exactly
-            normalized_path = filename.replace('\\', '/')
-
-            # Try each root node
-            for node in nodes:
-                candidate = os.path.join(self.root_path, normalized_path)
-                if candidate in self.node_map:
-                    return candidate
-        else:
-            # Just a filename - search for it
-            for path in self.node_map.keys():
-                if os.path.basename(path) == filename:
-                    return path
+            # It's a path - match it relative to the build root
+            return self.relpath_index.get(self._normalize_relpath(filename))
 
-        return None
+        # Just a filename - first match in tree order wins
+        candidates = self.basename_index.get(filename)
+        if not candidates:
+            return None
 
-    def _create_from_shorthand(self, filepath, content):
-        """Create a file from shorthand path notation."""
-        full_path = os.path.join(self.root_path, filepath.replace('\\', '/'))
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if len(candidates) > 1:
+            self.ambiguous_matches.append((filename, candidates[0], candidates))
+            self.logger.warning(
+                "Ambiguous fence filename: {0}", filename,
+                context=("At {0}; using {1}; other matches: {2}",
+                         self.locate(line_num), candidates[0], ", ".join(candidates[1:]))
+            )
 
-        with open(full_path, 'w') as f:
-            f.write(content)
-        self.created_files.add(full_path)
+        return candidates[0]
+
+    def _find_own_copy(self, filepath, content):
+        """Find an existing 'name (N).ext' copy of filepath written by an earlier build.
+
+        Returns (path, True) for an unmodified copy holding exactly content.
+        Failing that, in sync mode, returns (path, False) for the first
+        unmodified copy, which can be rewritten; otherwise (None, False).
+        """
+        if self.manifest is None:
+            return None, False
+
+        name, ext = os.path.splitext(filepath)
+        content_hash = BuildManifest.hash_text(content)
+        first_own = None
+        counter = 1
+        while True:
+            copy_path = "{0} ({1}){2}".format(name, counter, ext)
+            if not self._exists(copy_path):
+                break
+            if copy_path not in self._filled:
+                known_hash = self.manifest.unmodified_hash(copy_path)
+                if known_hash == content_hash:
+                    return copy_path, True
+                if known_hash is not None and first_own is None:
+                    first_own = copy_path
+            counter += 1
+
+        if self.sync and first_own:
+            return first_own, False
+        return None, False
 
     def _get_duplicate_filename(self, filepath):
         """Get a duplicate filename with (N) suffix."""
@@ -1015,38 +2724,545 @@ class TreeBuilder:
         while True:
             new_name = "{0} ({1}){2}".format(name, counter, ext)
             new_path = os.path.join(directory, new_name)
-            if not os.path.exists(new_path):
+            if not self._exists(new_path):
                 return new_path
             counter += 1
 
 
+class DirectoryFramer:
+    """Writes an existing directory out as a spec TreeParser can read back.
+
+    The reverse of a build: the directory is walked with an explicit stack of
+    os.scandir listings (no recursion, symlinked directories not followed)
+    and the spec is produced as a stream of text chunks, so arbitrarily large
+    trees never sit in memory as one string. Small text files can be
+    included as code fences after the tree.
+
+    Directories with no file to list are left out, since a childless entry
+    builds as a file. With max_depth set, that includes every directory at
+    that depth: entries are listed down to it, but directories there aren't
+    opened, so they're dropped along with whatever they hold.
+    Files that aren't inlined (too large, not UTF-8 text, content that would
+    close its fence, or a path no fence label can carry exactly) build as
+    empty files; a comment line after the fences names each of them.
+    """
+
+    BOX = 'box'
+    INDENTED = 'indented'
+
+    # Lines per chunk yielded by frame()
+    CHUNK_LINES = 1000
+
+    def __init__(self, style=BOX, ignore=None, max_depth=None,
+                 inline_max_bytes=DEFAULT_FRAME_INLINE_MAX_BYTES, progress=None):
+        self.style = style
+        self.ignore = DEFAULT_FRAME_IGNORE if ignore is None else ignore
+        self.max_depth = max_depth or None  # Deepest level listed; directories there are left out
+        self.inline_max_bytes = inline_max_bytes  # 0 disables inlining
+        self.progress = progress or BuildProgress()
+        self.dirs = 0
+        self.files = 0
+        self.inlined = 0
+        self.not_inlined = 0
+        self._filled = set()  # relpaths of directories known to hold a file to list
+
+    def _ignored(self, name, relpath):
+        return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern)
+                   for pattern in self.ignore)
+
+    def _listing(self, directory, relpath):
+        """Return sorted (name, relpath, is_dir, size) entries of directory, directories first."""
+        entries = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    child = posixpath.join(relpath, entry.name) if relpath else entry.name
+                    if self._ignored(entry.name, child):
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        size = 0 if is_dir else entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+                    entries.append((entry.name, child, is_dir, size))
+        except OSError:
+            return []
+        entries.sort(key=lambda e: (not e[2], e[0].lower()))
+        return entries
+
+    def _has_files(self, root, relpath, depth):
+        """Whether the directory relpath, at depth `depth`, holds a file to list.
+
+        Searches depth-first and stops at the first file found. The directories
+        on the way to it are remembered, so none is searched twice.
+        """
+        stack = [(relpath, depth)]
+        while stack:
+            current, level = stack.pop()
+            if self.max_depth is not None and level >= self.max_depth:
+                continue
+            if current in self._filled:
+                found = current
+                break
+            subdirs = []
+            for _, child, is_dir, _ in self._listing(os.path.join(root, current), current):
+                if not is_dir:
+                    found = current
+                    break
+                subdirs.append((child, level + 1))
+            else:
+                # Search the first subdirectory first, as the listing does
+                stack.extend(reversed(subdirs))
+                continue
+            break
+        else:
+            return False
+
+        while True:
+            self._filled.add(found)
+            if found == relpath:
+                return True
+            found = posixpath.dirname(found)
+
+    def _entries(self, root, relpath, depth):
+        """Return the listing of relpath that gets printed: files, and directories holding one."""
+        return [entry for entry in self._listing(os.path.join(root, relpath), relpath)
+                if not entry[2] or self._has_files(root, entry[1], depth)]
+
+    def _walk(self, root, inline):
+        """Yield the tree lines of root; collect (relpath, size) of non-empty files into `inline`."""
+        yield os.path.basename(os.path.normpath(root)) + "/"
+        box = self.style == self.BOX
+
+        # Each frame: (entries, next index, prefix for children, depth)
+        self._filled = set()
+        stack = [(self._entries(root, '', 1), 0, '', 1)]
+        while stack:
+            entries, index, prefix, depth = stack[-1]
+            if index >= len(entries):
+                stack.pop()
+                continue
+            stack[-1] = (entries, index + 1, prefix, depth)
+            self.progress.update("Framing: {0} entries", self.dirs + self.files)
+
+            name, relpath, is_dir, size = entries[index]
+            last = index == len(entries) - 1
+            if box:
+                line = prefix + ("└── " if last else "├── ") + name
+                child_prefix = prefix + ("    " if last else "│   ")
+            else:
+                line = "  " * depth + name
+                child_prefix = ''
+
+            if is_dir:
+                stack.append((self._entries(root, relpath, depth + 1), 0, child_prefix, depth + 1))
+                self.dirs += 1
+                yield line + "/"
+            else:
+                self.files += 1
+                yield line
+                if size and inline is not None:
+                    inline.append((relpath, size))
+
+    @staticmethod
+    def _fence_label(relpath):
+        """Return the line naming relpath above its fence, or None if none maps back exactly.
+
+        Labels always carry a slash, so they match by path rather than by basename.
+        """
+        label = relpath if '/' in relpath else './' + relpath
+        extracted = CodeFenceDetector._extract_filename(label)
+        if extracted and posixpath.normpath(extracted) == relpath:
+            return label
+        return None
+
+    @staticmethod
+    def _fence_safe(text):
+        """Whether text survives as fence content: no bare ``` would close the fence early."""
+        level = 0
+        for line in text.split('\n'):
+            stripped = line.strip()
+            if not stripped.startswith('```'):
+                continue
+            if stripped[3:].strip() or line[:1].isspace():
+                level += 1
+            elif level:
+                level -= 1
+            else:
+                return False
+        return level == 0
+
+    def _fences(self, root, inline):
+        """Yield the fence lines for the files in `inline`, then a note for each one left out."""
+        left_out = []
+        for index, (relpath, size) in enumerate(inline):
+            self.progress.update("Inlining files: {0}/{1}", index + 1, len(inline))
+            text, reason = self._inline_text(root, relpath, size)
+            if text is None:
+                left_out.append((relpath, reason))
+                continue
+
+            self.inlined += 1
+            yield self._fence_label(relpath)
+            yield "```"
+            # A trailing newline becomes an empty last line, which reads back as one
+            for line in text.split('\n'):
+                yield line
+            yield "```"
+            yield ""
+
+        # Comments, after the last fence so none is taken for a fence label
+        self.not_inlined = len(left_out)
+        for relpath, reason in left_out:
+            yield "<!-- Not inlined, builds as an empty file: {0} ({1}) -->".format(relpath, reason)
+
+    def _inline_text(self, root, relpath, size):
+        """Return (text, None) for a file that can be inlined, else (None, why not)."""
+        if size > self.inline_max_bytes:
+            return None, "over {0} bytes".format(self.inline_max_bytes)
+        if self._fence_label(relpath) is None:
+            return None, "no fence label can name this path"
+        try:
+            with open(os.path.join(root, relpath), 'r', encoding='utf-8') as f:
+                text = f.read()
+        except UnicodeDecodeError:
+            return None, "not UTF-8 text"
+        except (IOError, OSError) as e:
+            return None, "unreadable: {0}".format(e.strerror or e)
+        if not self._fence_safe(text):
+            return None, "its ``` lines would end the fence early"
+        return text, None
+
+    def _lines(self, root):
+        inline = [] if self.inline_max_bytes > 0 else None
+        yield "## Project Structure"
+        yield ""
+        for line in self._walk(root, inline):
+            yield line
+
+        if inline:
+            # Three blank lines end the tree for TreeDetector
+            yield ""
+            yield ""
+            yield ""
+            yield "## Files"
+            yield ""
+            for line in self._fences(root, inline):
+                yield line
+
+    def frame(self, root):
+        """Yield the spec for root as text chunks of up to CHUNK_LINES lines."""
+        chunk = []
+        for line in self._lines(root):
+            chunk.append(line)
+            if len(chunk) >= self.CHUNK_LINES:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+
+
+def count_nodes(nodes):
+    """Count nodes in a forest of TreeNodes, all levels included."""
+    count = 0
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        count += 1
+        pending.extend(node.children)
+    return count
+
+
+class BuildJob:
+    """Runs detection, parsing and building for one source text.
+
+    With `all_trees` set, every tree in the text is built into its own root;
+    the trees share one existence snapshot and one pool of writer threads,
+    and the stats add up over all of them.
+
+    `origin` is the (row, character) position of the text in its buffer, e.g.
+    the start of a selection, so messages can point at buffer positions.
+    `selections` adds more texts of the same buffer, as (text, origin, cache,
+    cache_key) tuples; their trees are built along with those of `text`, in
+    the same way as several trees of one text.
+
+    With `stream` set, a plain build of a single text skips the ParseCache
+    and hands its code fences to the builder through
+    CodeFenceDetector.iter_code_fences(), so each fence is written before
+    the next one is read.
+
+    The job never calls the Sublime API, so it can run on the async thread.
+    The command gathers the text up front and shows the result afterwards.
+    """
+
+    def __init__(self, text, source, document_path, progress=None, dry_run=False,
+                 max_workers=DEFAULT_MAX_WORKERS, base_path=None, verbose=False,
+                 log_max_bytes=DEFAULT_LOG_MAX_BYTES, log_backup_count=DEFAULT_LOG_BACKUP_COUNT,
+                 trace_path=None, cache=None, cache_key=None, manifest=False, sync=False,
+                 staged=False, archive=None, all_trees=False, origin=(0, 0), selections=None,
+                 stream=False):
+        self.text = text
+        self.source = source
+        self.document_path = document_path
+        self.progress = progress or BuildProgress()
+        self.dry_run = dry_run
+        self.max_workers = max_workers
+        # Directory the tree is built in; defaults to the document's folder
+        self.base_path = base_path or os.path.dirname(document_path)
+        # A dry run keeps its log in memory so nothing touches disk
+        self.logger = BuildLogger(self.base_path,
+                                  BuildLogger.DEBUG if verbose else BuildLogger.INFO,
+                                  stream=not dry_run,
+                                  max_bytes=log_max_bytes,
+                                  backup_count=log_backup_count)
+        self.trace = BuildTrace()
+        self.trace_path = trace_path  # JSONL file the trace is appended to, if any
+        # Parse of the previous build of the same buffer, and the buffer's change count
+        self.cache = cache or ParseCache()
+        self.cache_key = cache_key
+        self.manifest = manifest or sync  # Keep a BuildManifest in the build root
+        self.sync = sync  # Rewrite our own unmodified files whose fence content changed
+        self.staged = staged  # Write into a staging directory and commit at the end
+        self.archive = archive  # Write the tree into this zip/tar file instead of to disk
+        self.all_trees = all_trees  # Build every tree in the text, not just the first
+        self.origin = origin
+        self.stream = stream  # Read code fences lazily while building
+        # (text, origin, cache, cache_key) of every text built, `text` first
+        self.parts = [(text, origin, self.cache, cache_key)] + [
+            (part_text, part_origin, part_cache or ParseCache(), part_key)
+            for part_text, part_origin, part_cache, part_key in selections or ()]
+
+    def locate(self, line, part=0):
+        """Describe where line `line` of a text (`text` for part 0) is in its buffer, for messages."""
+        _, origin, cache, _ = self.parts[part]
+        doc = cache.doc
+        if line is None or doc is None or line >= len(doc):
+            return "line {0}".format(line)
+        row, offset = origin
+        begin, end = doc.line_span(line)
+        return "buffer line {0}, characters {1} to {2}".format(row + line + 1, offset + begin, offset + end)
+
+    def write_trace(self, outcome):
+        """Append this build's trace to trace_path, if one was given."""
+        if self.trace_path:
+            self.trace.write(self.trace_path, outcome)
+
+    # Stats that add up over the trees of a job
+    TOTALS = ('dirs', 'files', 'updated', 'skipped', 'ambiguous', 'fences')
+
+    def run(self):
+        """Build the tree (or every tree) and return the stats dict."""
+        logger = self.logger
+        progress = self.progress
+        trace = self.trace
+        parts = self.parts
+        chars = sum(len(text) for text, _, _, _ in parts)
+
+        trace.update(document=self.document_path, source=self.source,
+                     dry_run=self.dry_run, chars=chars)
+
+        logger.info("Building from {0}", self.source)
+        logger.info("Document: {0}", self.document_path)
+        logger.info("Text length: {0} characters", chars)
+
+        # (nodes, code fences, part index) of every tree to build
+        trees = []
+        streaming = self.stream and len(parts) == 1 and not (
+            self.all_trees or self.dry_run or self.staged or self.archive)
+        if streaming:
+            nodes, code_fences = self._parse_streaming(parts[0][0])
+            if nodes:
+                trees.append((nodes, code_fences, 0))
+        else:
+            # Each part's parse sets these on the trace; report them for all parts
+            totals = dict(lines=0, nodes=0, fences=0)
+            if self.all_trees:
+                totals['trees'] = 0
+            for index, (text, origin, cache, cache_key) in enumerate(parts):
+                if len(parts) > 1:
+                    logger.section("Selection {0} of {1}".format(index + 1, len(parts)))
+                    logger.info("Selection starts at buffer line {0}", origin[0] + 1)
+                part_trees = cache.parse_trees(
+                    text, cache_key, logger, progress, trace, all_trees=self.all_trees)
+                totals['lines'] += len(cache.doc)
+                if self.all_trees:
+                    totals['trees'] += len(part_trees)
+                for nodes, code_fences in part_trees:
+                    totals['nodes'] += count_nodes(nodes)
+                    totals['fences'] += len(code_fences)
+                    if nodes:
+                        trees.append((nodes, code_fences, index))
+            trace.update(**totals)
+
+        if not trees:
+            logger.error("No valid tree structure found")
+            raise BuildError("No valid tree structure found.")
+
+        output = None
+        snapshot = DirectorySnapshot()
+        if self.archive:
+            # An archive starts out empty: plan everything as new, relative to the base
+            output = ArchiveOutput(self.archive, self.base_path)
+            snapshot = DirectorySnapshot.offline_at(self.base_path)
+            logger.info("Writing archive: {0}", self.archive)
+
+        manifests = {}  # root path -> BuildManifest, for trees built into the same root
+        results = []
+        with ExitStack() as stack:
+            pool = stack.enter_context(ThreadPoolExecutor(max_workers=max(1, self.max_workers)))
+            if output is not None:
+                stack.enter_context(output)
+            for index, (nodes, code_fences, part) in enumerate(trees):
+                if len(trees) > 1:
+                    logger.section("Tree {0} of {1}".format(index + 1, len(trees)))
+                results.append(self._build(nodes, code_fences, snapshot, pool, output, manifests,
+                                           partial(self.locate, part=part)))
+
+        # Each builder sets its own operation counts on the trace; report the sum
+        operations = dict.fromkeys(BuildOperation.KINDS, 0)
+        for result in results:
+            for kind, count in result.pop('operations').items():
+                operations[kind] += count
+        trace.update(operations=operations)
+
+        if len(results) == 1:
+            stats = results[0]
+        else:
+            stats = dict((key, sum(result[key] for result in results)) for key in self.TOTALS)
+            stats['trees'] = len(results)
+            if len(parts) > 1:
+                stats['selections'] = len(parts)
+            trace.update(root=[result.pop('root') for result in results])
+            if self.dry_run:
+                plan = stats['plan'] = BuildPlan(self.base_path)
+                for result in results:
+                    plan.operations.extend(result['plan'])
+        stats.pop('root', None)
+        if self.archive:
+            stats['archive'] = self.archive
+
+        logger.info("Build completed successfully")
+        return stats
+
+    def _build(self, nodes, code_fences, snapshot, pool, output, manifests, locate):
+        """Build one tree; return its stats, with the root it was built in."""
+        logger = self.logger
+        trace = self.trace
+        root_path = self.base_path
+
+        logger.info("Parsed {0} root node(s)", len(nodes))
+
+        # Check if we need to use the parent directory as root
+        if len(nodes) > 1:
+            # Multiple root nodes, use current directory as root
+            logger.info("Multiple roots detected, using current directory")
+        else:
+            # Single root node, use it as the root directory
+            logger.info("Single root detected: {0}", nodes[0].name)
+            root_path = os.path.join(root_path, nodes[0].name)
+            nodes = nodes[0].children if not nodes[0].is_leaf else []
+
+        logger.info("Final root path: {0}", root_path)
+        trace.update(root=root_path)
+
+        manifest = None
+        if self.manifest and output is None:
+            manifest = manifests.get(root_path)
+            if manifest is None:
+                manifest = manifests[root_path] = BuildManifest.load(root_path)
+                logger.info("Manifest: {0} file(s) recorded", len(manifest.entries))
+
+        # Build the structure
+        builder = TreeBuilder(root_path, logger, self.progress, dry_run=self.dry_run,
+                              max_workers=self.max_workers, trace=trace, manifest=manifest,
+                              sync=self.sync, staged=self.staged, snapshot=snapshot, output=output,
+                              pool=pool, locate=locate)
+        stats = builder.build(nodes, code_fences)
+        stats['fences'] = builder.fence_count
+        stats['operations'] = builder.operation_counts
+        stats['root'] = root_path
+        return stats
+
+    def _parse_streaming(self, text):
+        """Detect and parse the tree of `text`; return (nodes, iterator of its code fences)."""
+        logger = self.logger
+        progress = self.progress
+        trace = self.trace
+
+        with trace.phase('tokenize'):
+            doc = DocumentLines(text)
+        trace.update(lines=len(doc))
+
+        progress.update("Detecting tree", force=True)
+        logger.section("Tree Detection")
+        with trace.phase('detect'):
+            tree_start, tree_end = TreeDetector.find_tree_start(text, doc)
+        logger.info("Tree range: lines {0} to {1}", tree_start, tree_end)
+
+        progress.update("Parsing tree", force=True)
+        logger.section("Tree Parsing")
+        with trace.phase('parse'):
+            nodes = TreeParser(text, start_line=tree_start, end_line=tree_end, doc=doc).parse()
+        trace.update(nodes=count_nodes(nodes))
+
+        logger.info("Code fences are read while building")
+        return nodes, CodeFenceDetector.iter_code_fences(text, logger, doc)
+
+
+# View id -> BuildProgress for builds currently running in the background
+_ACTIVE_BUILDS = {}
+
+# View id -> a ParseCache per selection, holding the parse of that view's last build
+_PARSE_CACHES = {}
+
+
 class BuildHandeeFrameCommand(sublime_plugin.TextCommand):
-    """Smart command that builds from selection if available, otherwise from document."""
+    """Smart command that builds from selection if available, otherwise from document.
 
-    def run(self, edit):
+    With several selections, all of them are built in one job.
+    """
+
+    def run(self, edit, background=None, dry_run=None, archive=None):
         # Check if text is selected
-        selection = self.view.sel()
-        has_selection = selection and len(selection) > 0 and not selection[0].empty()
+        regions = [region for region in self.view.sel() if not region.empty()]
 
-        if has_selection:
-            # Build from selection
-            region = selection[0]
-            text = self.view.substr(region)
+        if regions:
+            # Build from the selections
             source = "selection"
         else:
             # Build from entire document
-            region = sublime.Region(0, self.view.size())
-            text = self.view.substr(region)
+            regions = [sublime.Region(0, self.view.size())]
             source = "document"
 
-        if not text.strip():
+        # The change count identifies this exact buffer content for the parse cache
+        change_count = self.view.change_count()
+        parts = []
+        for region in regions:
+            text = self.view.substr(region)
+            if text.strip():
+                cache_key = (change_count, region.begin(), region.end())
+                origin = (self.view.rowcol(region.begin())[0], region.begin())
+                parts.append((text, cache_key, origin))
+
+        if not parts:
             sublime.error_message("No content to build from.")
             return
+        if len(parts) > 1:
+            source = "{0} selections".format(len(parts))
+
+        settings = sublime.load_settings(SETTINGS_FILE)
+        if background is None:
+            background = settings.get('run_in_background', True)
+        if dry_run is None:
+            dry_run = settings.get('dry_run', False)
 
-        self._build_tree(text, source)
+        self._build_tree(parts, source, background, dry_run, archive)
 
-    def _build_tree(self, text, source):
-        """Parse and build the tree structure."""
+    def _build_tree(self, parts, source, background=True, dry_run=False, archive=None):
+        """Parse and build the tree structure, on the async thread if requested.
+
+        `parts` lists the (text, cache key, buffer origin) of every text to build.
+        """
         # Determine root path first (needed for logger)
         current_file = self.view.file_name()
         if not current_file:
@@ -1057,82 +3273,252 @@ class BuildHandeeFrameCommand(sublime_plugin.TextCommand):
             )
             return
 
-        root_path = os.path.dirname(current_file)
-        logger = BuildLogger(root_path)
+        view_id = self.view.id()
+        if view_id in _ACTIVE_BUILDS:
+            sublime.status_message("HandeeFramer: a build is already running for this view")
+            return
 
-        try:
-            logger.info("Building from {0}".format(source))
-            logger.info("Document: {0}".format(current_file))
-            logger.info("Text length: {0} characters".format(len(text)))
-
-            # Detect tree start and end
-            logger.section("Tree Detection")
-            tree_start, tree_end = TreeDetector.find_tree_start(text)
-            logger.info("Tree range: lines {0} to {1}".format(tree_start, tree_end))
-
-            # Parse the tree
-            logger.section("Tree Parsing")
-            parser = TreeParser(text, start_line=tree_start, end_line=tree_end)
-            nodes = parser.parse()
-
-            if not nodes:
-                logger.error("No valid tree structure found")
-                sublime.error_message("No valid tree structure found.")
+        view = self.view
+        progress = BuildProgress(
+            lambda message: view.set_status(STATUS_KEY, "HandeeFramer: {0}".format(message)))
+        settings = sublime.load_settings(SETTINGS_FILE)
+        archive_path = None
+        if archive:
+            # `archive` is an extension such as "zip" or "tar.gz", or true for the setting
+            extension = archive if isinstance(archive, str) else settings.get('archive_format', 'zip')
+            archive_path = self._archive_path(current_file, extension)
+            if not ArchiveOutput.supported(archive_path):
+                sublime.error_message("HandeeFramer: unsupported archive format: {0}".format(extension))
                 return
 
-            logger.info("Parsed {0} root node(s)".format(len(nodes)))
-
-            # Detect code fences
-            code_fences = CodeFenceDetector.find_code_fences(text, logger)
+        caches = [None] * len(parts)
+        if settings.get('incremental_parse', True):
+            caches = _PARSE_CACHES.setdefault(view_id, [])
+            caches.extend(ParseCache() for _ in range(len(parts) - len(caches)))
+        else:
+            _PARSE_CACHES.pop(view_id, None)
+        (text, cache_key, origin), cache = parts[0], caches[0]
+        selections = [(part_text, part_origin, part_cache, part_key)
+                      for (part_text, part_key, part_origin), part_cache in zip(parts[1:], caches[1:])]
+        trace_path = None
+        if settings.get('write_trace', False) and not dry_run:
+            trace_path = os.path.join(os.path.dirname(current_file), TRACE_FILENAME)
+        job = BuildJob(text, source, current_file, progress, dry_run,
+                       max_workers=settings.get('max_workers', DEFAULT_MAX_WORKERS),
+                       verbose=settings.get('verbose', False),
+                       log_max_bytes=settings.get('log_max_bytes', DEFAULT_LOG_MAX_BYTES),
+                       log_backup_count=settings.get('log_backup_count', DEFAULT_LOG_BACKUP_COUNT),
+                       trace_path=trace_path, cache=cache, cache_key=cache_key,
+                       manifest=settings.get('write_manifest', False),
+                       sync=settings.get('collision_behavior', 'skip') == 'sync',
+                       staged=settings.get('staged_build', False), archive=archive_path,
+                       all_trees=settings.get('detect_all_trees', False), origin=origin,
+                       selections=selections)
+        _ACTIVE_BUILDS[view_id] = progress
+
+        if background:
+            sublime.set_timeout_async(lambda: self._run_job(job), 0)
+        else:
+            self._run_job(job)
 
-            # Check if we need to use the parent directory as root
-            if len(nodes) > 1:
-                # Multiple root nodes, use current directory as root
-                logger.info("Multiple roots detected, using current directory")
-            else:
-                # Single root node, use it as the root directory
-                logger.info("Single root detected: {0}".format(nodes[0].name))
-                root_path = os.path.join(root_path, nodes[0].name)
-                nodes = nodes[0].children if not nodes[0].is_leaf else []
+    @staticmethod
+    def _archive_path(document_path, extension):
+        """Archive next to the document, named after it; never an existing file."""
+        stem = os.path.splitext(document_path)[0]
+        path = "{0}.{1}".format(stem, extension)
+        counter = 1
+        while os.path.exists(path):
+            path = "{0} ({1}).{2}".format(stem, counter, extension)
+            counter += 1
+        return path
 
-            logger.info("Final root path: {0}".format(root_path))
+    def _run_job(self, job):
+        """Run a build job and hand the outcome back to the UI thread."""
+        logger = job.logger
+        try:
+            stats = job.run()
+            if job.dry_run:
+                # A dry run leaves the disk untouched unless there is an error to report
+                if logger.has_errors:
+                    logger.finalize()
+                sublime.set_timeout(lambda: self._show_plan(job, stats), 0)
+                return
 
-            # Build the structure
-            builder = TreeBuilder(root_path, logger)
-            stats = builder.build(nodes, code_fences)
+            logger.finalize(stats['dirs'], stats['files'], stats['skipped'])
+            job.write_trace('ok')
+            sublime.set_timeout(lambda: self._show_result(job, stats), 0)
 
-            logger.info("Build completed successfully")
+        except BuildCancelled:
+            logger.warning("Build cancelled by user")
             logger.finalize()
+            job.write_trace('cancelled')
+            sublime.set_timeout(
+                lambda: sublime.status_message("HandeeFramer: build cancelled"), 0)
 
-            # Show results
-            log_info = "\nLog: {0}".format(logger.get_log_path()) if logger.get_log_path() else ""
-            log_info = "\nLog: {0}".format(logger.get_log_path()) if logger.get_log_path() else ""
-            message = (
-                "HandeeFramer built successfully!\n\n"
-                "Source: {0}\n"
-                "Created {1} directories\n"
-                "Created {2} files\n"
-                "Skipped {3} existing items\n"
-                "Processed {4} code blocks"
-                "{5}"
-            ).format(source.capitalize(), stats['dirs'], stats['files'], 
-                     stats['skipped'], len(code_fences), log_info)
-            sublime.message_dialog(message)
+        except BuildError as e:
+            logger.finalize()
+            job.write_trace('error')
+            message = str(e)
+            sublime.set_timeout(lambda: sublime.error_message(message), 0)
 
         except Exception as e:
             logger.error("Build failed with exception", e)
             logger.finalize()
-            sublime.error_message(
+            job.write_trace('error')
+            message = (
                 "HandeeFramer encountered an error.\n\n"
                 "Error: {0}\n\n"
                 "Check log: {1}".format(str(e), logger.get_log_path())
             )
+            sublime.set_timeout(lambda: sublime.error_message(message), 0)
+
+        finally:
+            _ACTIVE_BUILDS.pop(self.view.id(), None)
+            self.view.erase_status(STATUS_KEY)
+
+    def _show_result(self, job, stats):
+        """Show the closing dialog (UI thread only)."""
+        settings = sublime.load_settings(SETTINGS_FILE)
+        log_path = job.logger.get_log_path()
+        log_info = "\nLog: {0}".format(log_path) if log_path else ""
+        ambiguous_info = ""
+        if stats['ambiguous']:
+            ambiguous_info = "\n{0} code block(s) matched several files (see log)".format(
+                stats['ambiguous'])
+        updated_info = ""
+        if stats['updated']:
+            updated_info = "Updated {0} files\n".format(stats['updated'])
+        if 'archive' in stats:
+            log_info = "\nArchive: {0}{1}".format(stats['archive'], log_info)
+        source = job.source.capitalize()
+        if 'trees' in stats:
+            source = "{0} ({1} trees)".format(source, stats['trees'])
+        message = (
+            "HandeeFramer built successfully!\n\n"
+            "Source: {0}\n"
+            "Created {1} directories\n"
+            "Created {2} files\n"
+            "{7}"
+            "Skipped {3} existing items\n"
+            "Processed {4} code blocks"
+            "{5}{6}"
+        ).format(source, stats['dirs'], stats['files'],
+                 stats['skipped'], stats['fences'], ambiguous_info, log_info, updated_info)
+
+        if settings.get('show_success_dialog', True):
+            sublime.message_dialog(message)
+        else:
+            sublime.status_message("HandeeFramer: created {0} directories, {1} files".format(
+                stats['dirs'], stats['files']))
+
+    def _show_plan(self, job, stats):
+        """Show a dry-run plan in a scratch view (UI thread only)."""
+        window = self.view.window()
+        if window is None:
+            return
+
+        plan_view = window.new_file()
+        plan_view.set_scratch(True)
+        plan_view.set_name("HandeeFramer Plan")
+        plan_view.run_command('append', {'characters': stats['plan'].describe() + "\n"})
+
+        sublime.status_message(
+            "HandeeFramer dry run: {0} directories, {1} files, {2} skipped".format(
+                stats['dirs'], stats['files'], stats['skipped']))
 
     def is_enabled(self):
         """Enable if view has content."""
         return self.view.size() > 0
 
 
+class CancelHandeeFrameCommand(sublime_plugin.TextCommand):
+    """Cancels the background build running for this view."""
+
+    def run(self, edit):
+        progress = _ACTIVE_BUILDS.get(self.view.id())
+        if progress:
+            progress.cancel()
+            self.view.set_status(STATUS_KEY, "HandeeFramer: cancelling...")
+
+    def is_enabled(self):
+        """Enable only while a build is running for this view."""
+        return self.view.id() in _ACTIVE_BUILDS
+
+
+class FrameHandeeDirectoryCommand(sublime_plugin.WindowCommand):
+    """Writes an existing directory out as a tree spec in a new view (reverse framing)."""
+
+    def run(self, dirs=None, path=None):
+        # Side bar passes `dirs`; otherwise ask, starting from the project folder
+        path = path or (dirs[0] if dirs else None)
+        if path:
+            self._frame(path)
+            return
+        self.window.show_input_panel("Directory to frame:", self._default_directory(),
+                                     self._frame, None, None)
+
+    def _default_directory(self):
+        folders = self.window.folders()
+        if folders:
+            return folders[0]
+        view = self.window.active_view()
+        if view and view.file_name():
+            return os.path.dirname(view.file_name())
+        return ""
+
+    def _frame(self, path):
+        path = os.path.expanduser(path.strip())
+        if not os.path.isdir(path):
+            sublime.error_message("HandeeFramer: not a directory:\n\n{0}".format(path))
+            return
+
+        view = self.window.new_file()
+        view.set_name("{0} (frame)".format(os.path.basename(os.path.normpath(path))))
+        view.assign_syntax('Packages/Markdown/Markdown.sublime-syntax')
+
+        settings = sublime.load_settings(SETTINGS_FILE)
+        progress = BuildProgress(
+            lambda message: view.set_status(STATUS_KEY, "HandeeFramer: {0}".format(message)))
+        framer = DirectoryFramer(
+            style=settings.get('frame_style', DirectoryFramer.BOX),
+            ignore=settings.get('frame_ignore', DEFAULT_FRAME_IGNORE),
+            max_depth=settings.get('frame_max_depth', 0),
+            inline_max_bytes=settings.get('frame_inline_max_bytes', DEFAULT_FRAME_INLINE_MAX_BYTES),
+            progress=progress)
+
+        # Registered like a build, so "Cancel Build" in the new view stops it
+        _ACTIVE_BUILDS[view.id()] = progress
+        sublime.set_timeout_async(lambda: self._stream(view, framer, path), 0)
+
+    def _stream(self, view, framer, path):
+        """Append the spec to the view chunk by chunk (async thread)."""
+        message = None
+        try:
+            for chunk in framer.frame(path):
+                sublime.set_timeout(
+                    lambda chunk=chunk: view.run_command('append', {'characters': chunk}), 0)
+            message = ("HandeeFramer: framed {0} directories, {1} files "
+                       "({2} inlined, {3} left empty)").format(
+                framer.dirs, framer.files, framer.inlined, framer.not_inlined)
+        except BuildCancelled:
+            message = "HandeeFramer: framing cancelled"
+        finally:
+            _ACTIVE_BUILDS.pop(view.id(), None)
+
+            def done():
+                view.erase_status(STATUS_KEY)
+                if message:
+                    sublime.status_message(message)
+            sublime.set_timeout(done, 0)
+
+
+class HandeeFramerViewListener(sublime_plugin.EventListener):
+    """Drops a view's cached parse when the view is closed."""
+
+    def on_close(self, view):
+        _PARSE_CACHES.pop(view.id(), None)
+
+
 # # Keep old commands for backward compatibility (they just call the new one)
 # class BuildTreeFromSelectionCommand(sublime_plugin.TextCommand):
 #     """Legacy command - redirects to unified command."""
@@ -1148,3 +3534,130 @@ class BuildHandeeFrameCommand(sublime_plugin.TextCommand):
 #         self.view.run_command('build_handee_frame')
 #     def is_enabled(self):
 #         return self.view.size() > 0
+
+
+def main(argv=None):
+    """Command line entry point: python -m handeeframer spec.md [--root DIR].
+
+    Prints one JSON object per spec with its build stats. Returns the exit
+    status: 0 if every spec built, 1 otherwise. With --frame DIR, prints a
+    spec of DIR instead.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m handeeframer",
+        description="Build file and folder structures from tree specs, without Sublime Text.")
+    parser.add_argument('specs', nargs='*', metavar='spec',
+                        help="text or markdown file containing a tree")
+    parser.add_argument('--root', metavar='DIR',
+                        help="directory to build in (default: each spec's own directory)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="plan the build and report it without writing anything")
+    parser.add_argument('--jobs', type=int, default=DEFAULT_MAX_WORKERS, metavar='N',
+                        help="threads writing file contents (default: {0})".format(DEFAULT_MAX_WORKERS))
+    parser.add_argument('--verbose', action='store_true',
+                        help="record every directory, file and fence in the build log")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="append a JSON-lines timing trace of every build to FILE")
+    parser.add_argument('--manifest', action='store_true',
+                        help="keep a manifest of written files so rebuilds skip unchanged ones")
+    parser.add_argument('--sync', action='store_true',
+                        help="rewrite previously generated, unedited files whose fence content "
+                             "changed (implies --manifest)")
+    parser.add_argument('--staged', action='store_true',
+                        help="write into a staging directory and move the result into place "
+                             "only if every file was written")
+    parser.add_argument('--archive', metavar='FILE',
+                        help="write the tree into a new .zip, .tar, .tar.gz, .tar.bz2 or .tar.xz "
+                             "file instead of the file system (one spec only)")
+    parser.add_argument('--stream', action='store_true',
+                        help="write each code fence as soon as it is read, so large specs "
+                             "never hold all their code in memory (plain builds only)")
+    parser.add_argument('--all-trees', action='store_true',
+                        help="build every tree in a spec, each under its own heading, "
+                             "not just the first")
+
+    frame = parser.add_argument_group("reverse framing")
+    frame.add_argument('--frame', metavar='DIR',
+                       help="print a tree spec of an existing directory instead of building")
+    frame.add_argument('--style', choices=[DirectoryFramer.BOX, DirectoryFramer.INDENTED],
+                       default=DirectoryFramer.BOX, help="tree notation (default: box)")
+    frame.add_argument('--max-depth', type=int, default=0, metavar='N',
+                       help="list entries down to depth N, leaving out directories there (default: no limit)")
+    frame.add_argument('--inline-max-bytes', type=int, default=DEFAULT_FRAME_INLINE_MAX_BYTES,
+                       metavar='N', help="inline text files up to N bytes as code fences, 0 for none "
+                                         "(default: {0})".format(DEFAULT_FRAME_INLINE_MAX_BYTES))
+    frame.add_argument('--ignore', action='append', default=[], metavar='PATTERN',
+                       help="also skip entries matching this glob (repeatable)")
+    args = parser.parse_args(argv)
+
+    if args.frame:
+        if not os.path.isdir(args.frame):
+            parser.error("not a directory: {0}".format(args.frame))
+        framer = DirectoryFramer(style=args.style, ignore=DEFAULT_FRAME_IGNORE + args.ignore,
+                                 max_depth=args.max_depth, inline_max_bytes=args.inline_max_bytes)
+        for chunk in framer.frame(args.frame):
+            sys.stdout.write(chunk)
+        return 0
+
+    if not args.specs:
+        parser.error("at least one spec is required (or --frame DIR)")
+    if args.archive and len(args.specs) > 1:
+        parser.error("--archive takes a single spec")
+    if args.archive and os.path.exists(args.archive):
+        parser.error("archive already exists: {0}".format(args.archive))
+
+    status = 0
+    for spec in args.specs:
+        result = {'spec': spec}
+        try:
+            with open(spec, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except (IOError, OSError) as e:
+            result['error'] = str(e)
+            print(json.dumps(result))
+            status = 1
+            continue
+
+        document_path = os.path.abspath(spec)
+        base_path = os.path.abspath(args.root) if args.root else None
+        job = BuildJob(text, "file", document_path, dry_run=args.dry_run,
+                       max_workers=args.jobs, base_path=base_path, verbose=args.verbose,
+                       trace_path=args.trace, manifest=args.manifest, sync=args.sync,
+                       staged=args.staged,
+                       archive=os.path.abspath(args.archive) if args.archive else None,
+                       all_trees=args.all_trees, stream=args.stream)
+        logger = job.logger
+        outcome = 'error'
+        try:
+            stats = job.run()
+            plan = stats.pop('plan', None)
+            if plan is not None:
+                stats['plan'] = [
+                    {'op': operation.kind, 'path': operation.path, 'note': operation.note}
+                    for operation in plan
+                ]
+            result['stats'] = stats
+            outcome = 'ok'
+        except BuildError as e:
+            result['error'] = str(e)
+            status = 1
+        except Exception as e:
+            logger.error("Build failed with exception", e)
+            result['error'] = "{0}: {1}".format(type(e).__name__, e)
+            status = 1
+
+        # A dry run leaves the disk untouched unless there is an error to report
+        if 'stats' in result and not args.dry_run:
+            logger.finalize(stats['dirs'], stats['files'], stats['skipped'])
+        elif logger.has_errors:
+            logger.finalize()
+        result['log'] = logger.get_log_path()
+        job.write_trace(outcome)
+
+        print(json.dumps(result))
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())